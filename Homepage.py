@@ -75,17 +75,20 @@ with gauche:
     st.markdown("## :one: Sélection des navires via la carte", unsafe_allow_html=True)
     
     m = folium.Map(location=[47,1], zoom_start=5, tiles='OpenStreetMap')
-    folium.GeoJson(
-    "heatmap.geojson",
-    style_function=style_function
-    ).add_to(m)
     Draw(export=True).add_to(m)
 
-    norm_density = matplotlib.colors.PowerNorm(gamma=1,vmin=0, vmax=10)
-    cmap_density = matplotlib.colormaps.get_cmap('jet')
-    colors = [matplotlib.colors.rgb2hex(cmap_density(norm_density(v))) for v in np.linspace(0,9,9)]
-    legend_html = make_gradient_legend('Densité des messages',colors=colors)
-    m.get_root().html.add_child(folium.Element(legend_html))
+    # Tuiles de densité du serveur local si configuré, sinon carte de densité précalculée
+    if not add_tile_layers(m, datetime(2025, 1, 1), datetime(2025, 12, 31)):
+        folium.GeoJson(
+        "heatmap.geojson",
+        style_function=style_function
+        ).add_to(m)
+
+        norm_density = matplotlib.colors.PowerNorm(gamma=1,vmin=0, vmax=10)
+        cmap_density = matplotlib.colormaps.get_cmap('jet')
+        colors = [matplotlib.colors.rgb2hex(cmap_density(norm_density(v))) for v in np.linspace(0,9,9)]
+        legend_html = make_gradient_legend('Densité des messages',colors=colors)
+        m.get_root().html.add_child(folium.Element(legend_html))
 
     draw_result = st_folium(m, width=800, height=800, key="flux_map",use_container_width=True)
 
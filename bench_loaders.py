@@ -0,0 +1,142 @@
+"""
+Benchmark des modes de chargement des points AIS : tuples psycopg2 (chemin historique) contre COPY binaire.
+
+Sans argument, les données sont synthétiques et seul le coût côté Python est mesuré :
+construction du DataFrame à partir d'une liste de tuples (fetchall + create_all_df)
+contre décodage du flux COPY binaire équivalent (decode_copy_points).
+
+Avec --dsn, les deux chemins sont mesurés de bout en bout sur un serveur PostgreSQL,
+à partir de lignes générées par generate_series (aucune table AIS nécessaire).
+
+Usage :
+    python bench_loaders.py
+    python bench_loaders.py --rows 1000000 10000000
+    python bench_loaders.py --dsn "host=localhost dbname=ais user=ais password=..."
+"""
+import argparse
+import gc
+import io
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+from func import _columns_to_dataframe, _copy_row_dtype, _copy_signature, _pg_epoch_us, copy_points_sql, decode_copy_points, points_columns
+
+
+def synthetic_columns(nb_rows: int, seed: int = 42) -> dict:
+    """
+    Génère nb_rows messages AIS aléatoires (5 000 navires, un an de messages) sous forme de colonnes NumPy.
+    """
+    rng = np.random.default_rng(seed)
+    start_us = int(datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp() * 1_000_000)
+    return {
+        "mmsi": rng.integers(200_000_000, 200_005_000, nb_rows, dtype=np.int64),
+        "lat": rng.uniform(41.0, 51.0, nb_rows),
+        "long": rng.uniform(-5.0, 9.0, nb_rows),
+        "cog": rng.uniform(0.0, 360.0, nb_rows),
+        "sog": rng.uniform(0.0, 25.0, nb_rows),
+        "timestamp": np.sort(rng.integers(start_us, start_us + 365 * 86_400_000_000, nb_rows)),
+    }
+
+
+def encode_copy_binary(columns: dict) -> bytes:
+    """
+    Encode des colonnes au format COPY binaire, tel que produit par copy_points_sql.
+    """
+    nb_rows = len(columns["mmsi"])
+    rec = np.empty(nb_rows, dtype=_copy_row_dtype)
+    rec["nb_fields"] = 6
+    for name in ("mmsi", "lat", "long", "cog", "sog", "timestamp"):
+        rec[f"len_{name}"] = 8
+    for name in ("mmsi", "lat", "long", "cog", "sog"):
+        rec[name] = columns[name]
+    rec["timestamp"] = columns["timestamp"] - _pg_epoch_us
+    header = _copy_signature + (0).to_bytes(4, "big") + (0).to_bytes(4, "big")
+    return header + rec.tobytes() + b"\xff\xff"
+
+
+def to_tuples(columns: dict) -> list:
+    """
+    Convertit des colonnes en liste de tuples, comme les renverrait cursor.fetchall().
+    """
+    base = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    timestamps = [base + timedelta(microseconds=int(us)) for us in columns["timestamp"]]
+    return list(zip(columns["mmsi"].tolist(), columns["lat"].tolist(), columns["long"].tolist(),
+                    columns["cog"].tolist(), columns["sog"].tolist(), timestamps))
+
+
+def timed(label: str, fn, *args):
+    gc.collect()
+    t0 = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - t0
+    print(f"  {label:<38} {elapsed:8.3f} s")
+    return result, elapsed
+
+
+def bench_offline(nb_rows: int) -> None:
+    print(f"\n{nb_rows:,} lignes synthétiques (décodage côté Python uniquement)")
+    columns = synthetic_columns(nb_rows)
+
+    rows = to_tuples(columns)
+    df_tuples, t_tuples = timed("tuples -> DataFrame (fetchall)", pd.DataFrame, rows, None, points_columns)
+    del rows
+
+    payload = encode_copy_binary(columns)
+    df_copy, t_copy = timed("COPY binaire -> DataFrame", lambda p: _columns_to_dataframe(decode_copy_points(p)), payload)
+
+    assert len(df_tuples) == len(df_copy)
+    assert np.array_equal(df_tuples["mmsi"].to_numpy(), df_copy["mmsi"].to_numpy())
+    print(f"  accélération : x{t_tuples / max(t_copy, 1e-9):.1f}")
+
+
+def bench_live(dsn: str, nb_rows: int) -> None:
+    print(f"\n{nb_rows:,} lignes générées par le serveur (requête + transfert + décodage)")
+    sql = f"""
+        SELECT (200000000 + i % 5000)::int8 AS mmsi,
+               41 + random() * 10 AS lat,
+               -5 + random() * 14 AS long,
+               random() * 360 AS cog,
+               random() * 25 AS sog,
+               timestamptz '2025-01-01' + i * interval '1 second' AS timestamp
+        FROM generate_series(1, {nb_rows}) AS i
+        """
+    conn = psycopg2.connect(dsn)
+    try:
+        def fetchall():
+            cur = conn.cursor()
+            cur.execute(sql)
+            df = pd.DataFrame(cur.fetchall(), columns=points_columns)
+            cur.close()
+            return df
+
+        def copy():
+            buffer = io.BytesIO()
+            cur = conn.cursor()
+            cur.copy_expert(copy_points_sql(sql), buffer)
+            cur.close()
+            return _columns_to_dataframe(decode_copy_points(buffer.getbuffer()))
+
+        _, t_fetchall = timed("fetchall -> DataFrame", fetchall)
+        conn.rollback()
+        _, t_copy = timed("COPY binaire -> DataFrame", copy)
+        conn.rollback()
+        print(f"  accélération : x{t_fetchall / max(t_copy, 1e-9):.1f}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare le chargement par tuples et par COPY binaire.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000_000, 10_000_000], help="Nombres de lignes à tester.")
+    parser.add_argument("--dsn", default=None, help="Chaîne de connexion PostgreSQL pour le benchmark de bout en bout.")
+    args = parser.parse_args()
+
+    for nb_rows in args.rows:
+        if args.dsn:
+            bench_live(args.dsn, nb_rows)
+        else:
+            bench_offline(nb_rows)
@@ -1,23 +1,118 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
 import folium
+from folium.utilities import JsCode
+from branca.element import MacroElement, Template
 import matplotlib
 import psycopg2
+import psycopg2.pool
 import math
 from math import radians,sin,cos,atan2,sqrt
 import geopandas as gpd
 from shapely.geometry import Point
 from shapely.geometry import Polygon
+import shapely
 import numpy as np
 from pyproj import Transformer
-from datetime import datetime
-from typing import List, Optional, Tuple
+from datetime import datetime, timedelta
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
+import io
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import functools
+from concurrent.futures import wait
 
 #bdd="dyn_vm_nice_bigdata"
 #bdd="dyn_filtered_full"
 bdd="dyn_filtered_clean_code"
 
+# Les dates de la sélection et les timestamps renvoyés sont en UTC, quel que soit le fuseau (TimeZone) de la session PostgreSQL :
+# une date sans fuseau est lue comme une heure UTC, et les bornes des jours de la sélection sont des jours UTC
+
+# Paramètres des pools de connexions (un pool par secret : local, pgsql, vm)
+pool_max_size=8
+pool_max_idle_s=300
+pool_checkout_timeout_s=30
+pool_health_check_s=60
+
+# Durée maximale (ms) d'une requête côté serveur, appliquée à chaque connexion des pools
+statement_timeout_ms=120000
+
+# Nombre de lignes récupérées par aller-retour en mode "stream" (curseur côté serveur)
+stream_batch_size=50000
+
+points_columns=["mmsi","lat", "long","cog","sog", "timestamp"]
+
+# Nombre de threads utilisés pour exécuter en parallèle les requêtes indépendantes
+fetch_workers=4
+
+# Connexions de chaque pool prêtées aux threads supplémentaires des requêtes parallèles (fetch_executor), partagées par
+# toutes les sessions : quand elles sont prises, les requêtes d'une session s'exécutent à la suite au lieu d'attendre le pool.
+# Chaque session n'utilise alors qu'une connexion par pool : pool_max_size - fetch_parallel_slots sessions peuvent interroger
+# la base en même temps sans attente (au-delà, pool_checkout_timeout_s s'applique)
+fetch_parallel_slots=4
+
+# Découpage temporel des grosses requêtes de points : au plus shard_max_count morceaux exécutés en parallèle,
+# chacun couvrant au moins shard_min_days jours
+shard_max_count=4
+shard_min_days=14
+
+# Profondeur (en jours) de la recherche du dernier message de chaque navire en mode photo
+snapshot_lookback_days=150
+
+# Durée de validité (s) des données statiques IHS gardées en mémoire, et taille des lots de MMSI demandés à la base
+ihs_ttl_s=24*3600
+ihs_batch_size=5000
+
+# Planification des requêtes de points : au-delà de planner_row_budget lignes estimées, les points sont échantillonnés
+# par la base, et au-delà de planner_sample_max_factor fois ce budget, ils sont agrégés par cellule de grille
+planner_row_budget=500000
+planner_sample_max_factor=10
+planner_default_cell_deg=0.05
+
+# Marge appliquée au taux d'échantillonnage côté base, l'échantillon est ensuite ramené à la taille exacte en mémoire
+sample_oversampling=1.1
+
+# Taille mémoire maximale (octets) du cache sémantique des requêtes de points
+points_cache_max_bytes=2*1024**3
+
+# Mode densité (raster) : largeur de l'image en pixels (hauteur plafonnée à raster_max_px), et nombre maximum
+# de messages récupérés pour la construire (au-delà, plan_points_query échantillonne)
+raster_width_px=1200
+raster_max_px=2000
+raster_row_budget=2000000
+
+# Serveur de tuiles local (tile_server.py) : URL de base, ex "http://localhost:8600" (None : couches de tuiles désactivées),
+# dossier du cache disque des tuiles, plage de la légende de densité (messages par km²) et zoom minimum des trajectoires
+tile_server_url=None
+tile_cache_dir="tile_cache"
+tile_density_range=(0.1, 10000)
+tile_tracks_min_zoom=8
+
+# Mode agrégation : nombre de cellules sur la largeur de la carte à l'ouverture (map_settings), nombre de messages
+# en dessous duquel les messages sont affichés directement, et nombre de niveaux de zoom au-delà du zoom d'ouverture
+# à partir duquel les cellules sont remplacées par l'échantillon de messages
+aggregation_cells_across=60
+aggregation_min_points=5000
+aggregation_points_zoom=2
+
+# Écart (s) entre deux messages consécutifs d'un navire au-delà duquel sa trajectoire est coupée (None : jamais)
+traj_max_gap_s=6*3600
+
+ihs_columns=['mmsi', 'Ship type from IHS', 'Ship type ID', 'a', 'b', 'c', 'd', 'Draft']
+
+# Types compacts des colonnes des DataFrames de points et IHS (create_all_df, ihs_store)
+points_dtypes={"mmsi": np.int64, "lat": np.float32, "long": np.float32, "cog": np.float32, "sog": np.float32}
+# Les dimensions restent en float32 (NaN si inconnues) : les pages de graphiques les passent à NumPy / matplotlib
+ihs_dtypes={'Ship type ID': "Int32", 'a': np.float32, 'b': np.float32, 'c': np.float32, 'd': np.float32, 'Draft': np.float32,
+            'Length': np.float32, 'Width': np.float32, 'Size parameter': np.float32}
+
 def haversine_dist_m(lat1 : float, lon1 : float, lat2 : float, lon2 : float) -> float:
     """
     Calcule la distance en mètres entre deux points géographiques.
@@ -64,18 +159,1171 @@ def connect_vm() -> Optional[psycopg2.extensions.connection]:
         return None
 
 
-       
+class pool_timeout(psycopg2.pool.PoolError):
+    """
+    Levée quand aucune connexion du pool ne se libère avant checkout_timeout_s secondes.
+    Sous-classe de psycopg2.Error : elle est traitée comme les autres erreurs de base de données par les appelants.
+    """
+
+
+class pgsql_pool():
+    """
+    Pool de connexions PostgreSQL partagé par toutes les sessions et tous les reruns du processus Streamlit.
+
+    Les connexions sont réutilisées au lieu d'être ouvertes et fermées à chaque requête.
+    Une connexion est vérifiée (SELECT 1) avant d'être rendue si elle est restée inactive trop longtemps,
+    les connexions inactives depuis plus de max_idle_s secondes sont fermées, et le temps d'attente
+    de chaque emprunt est mesuré.
+
+    Attributes:
+        secret_name (str): Nom de la section de st.secrets utilisée pour se connecter ('local', 'pgsql' ou 'vm').
+        max_size (int): Nombre maximum de connexions ouvertes simultanément.
+        max_idle_s (float): Durée d'inactivité (s) au-delà de laquelle une connexion libre est fermée.
+        checkout_timeout_s (float): Durée maximale (s) d'attente d'une connexion libre.
+        health_check_s (float): Durée d'inactivité (s) au-delà de laquelle une connexion est testée avant d'être prêtée.
+        statement_timeout_ms (int): Durée maximale (ms) d'une requête (statement_timeout de chaque connexion).
+        stats (dict): Compteurs (connexions créées, emprunts, fermetures, temps d'attente cumulé et maximum).
+
+    Methods:
+        getconn() -> psycopg2.extensions.connection:
+            Emprunte une connexion saine, en attendant au plus checkout_timeout_s secondes.
+
+        putconn(conn, discard=False):
+            Rend une connexion au pool (ou la ferme si elle est inutilisable).
+
+        connection():
+            Context manager qui emprunte puis rend automatiquement une connexion.
+
+        reap_idle():
+            Ferme les connexions libres inactives depuis plus de max_idle_s secondes.
+
+        closeall():
+            Ferme toutes les connexions libres.
+    """
+    def __init__(self, secret_name: str, max_size: int = pool_max_size, max_idle_s: float = pool_max_idle_s,
+                 checkout_timeout_s: float = pool_checkout_timeout_s, health_check_s: float = pool_health_check_s,
+                 statement_timeout_ms: int = statement_timeout_ms):
+        """
+        Initialise un pool vide. Les connexions sont ouvertes à la demande.
+
+        Args:
+            secret_name (str): Nom de la section de st.secrets ('local', 'pgsql' ou 'vm').
+            max_size (int): Nombre maximum de connexions ouvertes simultanément.
+            max_idle_s (float): Durée d'inactivité (s) avant fermeture d'une connexion libre.
+            checkout_timeout_s (float): Durée maximale (s) d'attente d'une connexion libre.
+            health_check_s (float): Durée d'inactivité (s) avant de tester une connexion libre.
+            statement_timeout_ms (int): Durée maximale (ms) d'une requête, appliquée à chaque nouvelle connexion.
+        """
+        self.secret_name = secret_name
+        self.statement_timeout_ms = statement_timeout_ms
+        self.max_size = max_size
+        self.max_idle_s = max_idle_s
+        self.checkout_timeout_s = checkout_timeout_s
+        self.health_check_s = health_check_s
+
+        self._idle: List[Tuple[psycopg2.extensions.connection, float]] = []
+        self._nb_open: int = 0
+        self._cond = threading.Condition()
+        self.stats: dict = {
+            "created": 0,
+            "checkouts": 0,
+            "closed": 0,
+            "wait_s_total": 0.0,
+            "wait_s_max": 0.0,
+        }
+
+    def _connect(self) -> psycopg2.extensions.connection:
+        try:
+            conn = psycopg2.connect(**st.secrets[self.secret_name])
+            cur = conn.cursor()
+            cur.execute("SET statement_timeout = %s", (self.statement_timeout_ms,))
+            cur.close()
+            conn.commit()
+        except Exception as e:
+            st.error(f"Erreur de connexion ({self.secret_name}) : {e}")
+            raise
+        with self._cond:
+            self.stats["created"] += 1
+        return conn
+
+    def _is_healthy(self, conn: psycopg2.extensions.connection, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_s:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn: psycopg2.extensions.connection) -> None:
+        # Fermeture hors du verrou, seuls les compteurs sont mis à jour sous le verrou
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self.stats["closed"] += 1
+            self._nb_open -= 1
+            self._cond.notify()
+
+    def getconn(self) -> psycopg2.extensions.connection:
+        """
+        Emprunte une connexion au pool. Réutilise une connexion libre si possible,
+        en ouvre une nouvelle si le pool n'est pas plein, sinon attend qu'une connexion soit rendue.
+        Le test de santé (SELECT 1) d'une connexion libre est fait hors du verrou :
+        les autres sessions ne sont pas bloquées par une connexion qui ne répond plus.
+
+        Returns:
+            psycopg2.extensions.connection: Connexion prête à l'emploi.
+
+        Raises:
+            pool_timeout: Si aucune connexion n'est disponible après checkout_timeout_s secondes.
+        """
+        t0 = time.monotonic()
+        self.reap_idle()
+        while True:
+            with self._cond:
+                while not self._idle and self._nb_open >= self.max_size:
+                    remaining = self.checkout_timeout_s - (time.monotonic() - t0)
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        raise pool_timeout(
+                            f"Aucune connexion disponible ({self.secret_name}) après {self.checkout_timeout_s} s."
+                        )
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                else:
+                    self._nb_open += 1
+                    conn = None
+
+            if conn is None:
+                break
+            if self._is_healthy(conn, last_used):
+                self._record_checkout(t0)
+                return conn
+            self._discard(conn)
+
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._nb_open -= 1
+                self._cond.notify()
+            raise
+        self._record_checkout(t0)
+        return conn
+
+    def _record_checkout(self, t0: float) -> None:
+        wait_s = time.monotonic() - t0
+        with self._cond:
+            self.stats["checkouts"] += 1
+            self.stats["wait_s_total"] += wait_s
+            self.stats["wait_s_max"] = max(self.stats["wait_s_max"], wait_s)
+
+    def putconn(self, conn: psycopg2.extensions.connection, discard: bool = False) -> None:
+        """
+        Rend une connexion au pool. La transaction en cours est annulée pour que la connexion
+        soit rendue dans un état propre.
+
+        Args:
+            conn: Connexion empruntée via getconn().
+            discard: Si True, la connexion est fermée au lieu d'être réutilisée.
+        """
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        if discard or conn.closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager qui emprunte une connexion et la rend à la sortie du bloc.
+        En cas d'erreur de connexion (psycopg2.OperationalError / InterfaceError), la connexion est fermée.
+        Pendant le bloc, la connexion est enregistrée dans le query_scope du thread courant pour pouvoir être annulée.
+        Pendant le premier essai de run_cancellable (scope probe), aucune connexion n'est empruntée : _database_needed est levée.
+
+        Yields:
+            psycopg2.extensions.connection: Connexion empruntée.
+        """
+        scope = current_query_scope()
+        if scope is not None and scope.probe:
+            raise _database_needed()
+        conn = self.getconn()
+        if scope is not None:
+            scope.add(conn)
+        discard = False
+        try:
+            yield conn
+        except psycopg2.extensions.QueryCanceledError:
+            raise
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            if scope is not None:
+                scope.discard(conn)
+            self.putconn(conn, discard=discard)
+
+    def reap_idle(self) -> None:
+        """
+        Ferme les connexions libres inactives depuis plus de max_idle_s secondes.
+        """
+        now = time.monotonic()
+        with self._cond:
+            expired = [conn for conn, last_used in self._idle if now - last_used > self.max_idle_s]
+            self._idle = [(conn, last_used) for conn, last_used in self._idle if now - last_used <= self.max_idle_s]
+        # Fermeture hors du verrou : une socket lente à fermer ne bloque pas les autres emprunts
+        for conn in expired:
+            self._discard(conn)
+
+    def closeall(self) -> None:
+        """
+        Ferme toutes les connexions libres du pool.
+        """
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle = []
+        for conn in idle:
+            self._discard(conn)
+
+
+@st.cache_resource
+def get_pool(secret_name: str) -> pgsql_pool:
+    """
+    Renvoie le pool de connexions associé à un secret. Le pool est créé une seule fois
+    par processus et partagé entre toutes les sessions (st.cache_resource).
+
+    Args:
+        secret_name : Nom de la section de st.secrets ('local', 'pgsql' ou 'vm').
+
+    Returns:
+        pgsql_pool : Pool de connexions partagé.
+    """
+    return pgsql_pool(secret_name)
+
+
+
+class query_too_large(Exception):
+    """
+    Levée quand une requête dépasse statement_timeout_ms. Contient l'estimation du nombre de lignes
+    (EXPLAIN) pour expliquer à l'utilisateur pourquoi la requête est trop lourde.
+    """
+    def __init__(self, estimated_rows: Optional[int] = None):
+        self.estimated_rows = estimated_rows
+        estimate = f"environ {estimated_rows:,} lignes estimées".replace(",", " ") if estimated_rows is not None else "taille inconnue"
+        super().__init__(
+            f"Requête trop volumineuse : elle a dépassé la limite de {statement_timeout_ms / 1000:.0f} s ({estimate})."
+            " Réduisez la zone, la période ou la liste de MMSI."
+        )
+
+
+class _database_needed(BaseException):
+    """
+    Levée par pgsql_pool.connection() pendant le premier essai de run_cancellable, quand l'appel doit interroger la base.
+    Dérive de BaseException pour ne pas être interceptée par les `except Exception` / `except psycopg2.Error` des appelants.
+    """
+
+
+class query_scope():
+    """
+    Ensemble des connexions utilisées par une exécution de script, pour pouvoir annuler côté serveur
+    toutes les requêtes en cours quand Streamlit interrompt le script (rerun après un changement de widget).
+    Un scope probe ne prête aucune connexion (voir run_cancellable).
+    """
+    def __init__(self, probe: bool = False):
+        self.probe = probe
+        self.cancelled = False
+        self._conns: set = set()
+        self._lock = threading.Lock()
+
+    def add(self, conn: psycopg2.extensions.connection) -> None:
+        with self._lock:
+            self._conns.add(conn)
+            cancelled = self.cancelled
+        if cancelled:
+            conn.cancel()
+
+    def discard(self, conn: psycopg2.extensions.connection) -> None:
+        with self._lock:
+            self._conns.discard(conn)
+
+    def cancel(self) -> None:
+        """
+        Annule côté serveur (pg_cancel_backend) toutes les requêtes en cours de ce scope.
+        """
+        with self._lock:
+            self.cancelled = True
+            conns = list(self._conns)
+        for conn in conns:
+            try:
+                conn.cancel()
+            except psycopg2.Error:
+                pass
+
+
+_thread_scope = threading.local()
+
+
+def current_query_scope() -> Optional[query_scope]:
+    """
+    Renvoie le query_scope du thread courant, ou None hors d'une exécution annulable.
+    """
+    return getattr(_thread_scope, "scope", None)
+
+
+def run_cancellable(fn, *args, **kwargs):
+    """
+    Exécute fn dans un thread séparé pendant que le thread du script attend en affichant la durée écoulée.
+    Cet affichage laisse à Streamlit la possibilité d'interrompre le script dès qu'un widget change :
+    les requêtes en cours sont alors annulées côté serveur au lieu de continuer à tourner.
+    Si une requête dépasse statement_timeout_ms, un message d'erreur explicite est affiché et le script s'arrête.
+
+    fn est d'abord essayée sur le thread du script avec un scope probe : si le résultat vient d'un cache
+    (st.cache_data, cache de points, cache IHS), il est renvoyé sans thread ni affichage. Le thread n'est lancé
+    que si fn doit emprunter une connexion (_database_needed). fn ne doit donc modifier ses arguments
+    qu'après son premier accès à la base.
+    Hors de Streamlit, ou si l'appel est déjà fait depuis une exécution annulable, fn est appelée directement.
+
+    Args :
+            fn : Fonction à exécuter.
+            *args, **kwargs : Arguments de fn.
+
+    Returns :
+            Valeur renvoyée par fn.
+    """
+    ctx = get_script_run_ctx()
+    if ctx is None or current_query_scope() is not None:
+        return fn(*args, **kwargs)
+
+    _thread_scope.scope = query_scope(probe=True)
+    try:
+        return fn(*args, **kwargs)
+    except _database_needed:
+        pass
+    finally:
+        _thread_scope.scope = None
+
+    scope = query_scope()
+
+    def target():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        _thread_scope.scope = scope
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _thread_scope.scope = None
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(target)
+    executor.shutdown(wait=False)
+    placeholder = st.empty()
+    t0 = time.monotonic()
+    try:
+        while not wait([future], timeout=0.25).done:
+            elapsed = time.monotonic() - t0
+            if elapsed > 0.5:
+                placeholder.caption(f"⏳ Requête en cours ({elapsed:.0f} s)...")
+        return future.result()
+    except query_too_large as e:
+        placeholder.empty()
+        st.error(str(e))
+        st.stop()
+    except psycopg2.extensions.QueryCanceledError:
+        placeholder.empty()
+        st.error(query_too_large().args[0])
+        st.stop()
+    except BaseException:
+        scope.cancel()
+        raise
+    finally:
+        placeholder.empty()
+
+
+def cancellable(fn):
+    """
+    Décorateur : les appels à fn passent par run_cancellable.
+    À placer au-dessus de @st.cache_data pour que les requêtes soient aussi annulables lors d'un cache miss.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return run_cancellable(fn, *args, **kwargs)
+    return wrapper
+
+
+def estimate_rows(secret_name: str, sql: str) -> Optional[int]:
+    """
+    Estime le nombre de lignes renvoyées par une requête d'après le plan du planificateur PostgreSQL (EXPLAIN),
+    sans l'exécuter.
+
+    Args :
+            secret_name : Nom du pool à utiliser ('local', 'pgsql' ou 'vm').
+            sql : Requête SELECT.
+
+    Returns :
+            Nombre de lignes estimé, ou None si l'estimation a échoué.
+    """
+    try:
+        with get_pool(secret_name).connection() as conn_loc:
+            cur_loc = conn_loc.cursor()
+            cur_loc.execute(f"EXPLAIN (FORMAT JSON) {sql.strip().rstrip(';')}")
+            plan = cur_loc.fetchone()[0]
+            cur_loc.close()
+    except psycopg2.Error:
+        return None
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class _columns_builder():
+    """
+    Tableaux NumPy extensibles (un par colonne de points_columns) remplis lot par lot.
+    La capacité double quand elle est atteinte, la mémoire reste donc proportionnelle au nombre de lignes
+    et non au nombre d'objets Python.
+    """
+    dtypes = {"mmsi": np.int64, "lat": np.float64, "long": np.float64,
+              "cog": np.float64, "sog": np.float64, "timestamp": np.int64}
+
+    def __init__(self, capacity: int = stream_batch_size):
+        self.size = 0
+        self.arrays = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.dtypes.items()}
+
+    def append(self, columns: dict) -> None:
+        n = len(columns["mmsi"])
+        capacity = len(self.arrays["mmsi"])
+        if self.size + n > capacity:
+            new_capacity = max(2 * capacity, self.size + n)
+            for name, arr in self.arrays.items():
+                grown = np.empty(new_capacity, dtype=arr.dtype)
+                grown[:self.size] = arr[:self.size]
+                self.arrays[name] = grown
+        for name, arr in self.arrays.items():
+            arr[self.size:self.size + n] = columns[name]
+        self.size += n
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return _columns_to_dataframe({name: arr[:self.size] for name, arr in self.arrays.items()})
+
+    def to_messages(self) -> "ais_messages":
+        return ais_messages({name: arr[:self.size] for name, arr in self.arrays.items()})
+
+
+def _columns_to_dataframe(columns: dict) -> pd.DataFrame:
+    """
+    Construit le DataFrame de points (colonnes points_columns) à partir de tableaux NumPy,
+    les timestamps étant donnés en nanosecondes depuis l'epoch (UTC).
+    """
+    df = pd.DataFrame({name: columns[name] for name in points_columns})
+    df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ns", utc=True)
+    return df
+
+
+class ais_messages():
+    """
+    Messages AIS stockés en colonnes NumPy contiguës (une par colonne de points_columns), triés par (mmsi, timestamp).
+
+    Les messages d'un même navire sont consécutifs : offsets[i]:offsets[i + 1] délimite ceux de vessels[i].
+    Les filtres et les fonctions d'affichage parcourent ainsi les navires par tranches de tableaux,
+    sans groupby ni objet Python par ligne.
+
+    Attributes:
+        columns (dict[str, np.ndarray]): mmsi en int64, lat/long/cog/sog en float64, timestamp en nanosecondes depuis l'epoch (int64).
+        vessels (np.ndarray): MMSI distincts, par ordre croissant.
+        offsets (np.ndarray): Indice du premier message de chaque navire, suivi du nombre total de messages.
+        order (np.ndarray): Permutation appliquée aux lignes d'origine (la ligne i triée est la ligne order[i] d'origine).
+
+    Methods:
+        from_dataframe(df) -> ais_messages:
+            Construit le conteneur à partir d'un DataFrame avec les colonnes points_columns.
+
+        vessel(mmsi) -> slice:
+            Tranche des messages d'un navire (vide s'il est absent).
+
+        iter_vessels() -> Iterator[Tuple[int, slice]]:
+            Parcourt les navires et leurs tranches.
+
+        counts() -> np.ndarray:
+            Nombre de messages de chaque navire de vessels.
+
+        take(idx) -> ais_messages:
+            Sous-ensemble des messages (masque booléen ou indices dans l'ordre trié).
+
+        to_dataframe() -> pd.DataFrame:
+            DataFrame des messages (colonnes points_columns), pour make_dataframe et create_all_df.
+    """
+    def __init__(self, columns: dict, presorted: bool = False):
+        """
+        Trie les colonnes par (mmsi, timestamp) et construit l'index des navires.
+
+        Args:
+            columns (dict): {colonne: tableau} pour chaque colonne de points_columns (timestamp en nanosecondes depuis l'epoch).
+            presorted (bool): Colonnes déjà triées par (mmsi, timestamp), le tri est alors évité.
+        """
+        mmsi = np.asarray(columns["mmsi"], dtype=np.int64)
+        timestamp = np.asarray(columns["timestamp"], dtype=np.int64)
+        self.order = np.arange(len(mmsi)) if presorted else np.lexsort((timestamp, mmsi))
+        self.columns = {
+            name: np.ascontiguousarray(np.asarray(columns[name], dtype=dtype)[self.order])
+            for name, dtype in _columns_builder.dtypes.items()
+        }
+
+        sorted_mmsi = self.columns["mmsi"]
+        starts = np.flatnonzero(np.diff(sorted_mmsi)) + 1
+        starts = np.concatenate(([0], starts)) if len(sorted_mmsi) else starts
+        self.vessels = sorted_mmsi[starts]
+        self.offsets = np.append(starts, len(sorted_mmsi))
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame) -> "ais_messages":
+        columns = {name: df[name].to_numpy() for name in points_columns if name != "timestamp"}
+        columns["timestamp"] = pd.DatetimeIndex(df["timestamp"]).asi8
+        return cls(columns)
+
+    def __len__(self) -> int:
+        return len(self.columns["mmsi"])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(arr.nbytes for arr in self.columns.values())
+
+    def counts(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def vessel(self, mmsi: int) -> slice:
+        i = np.searchsorted(self.vessels, int(mmsi))
+        if i == len(self.vessels) or self.vessels[i] != int(mmsi):
+            return slice(0, 0)
+        return slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def iter_vessels(self) -> Iterator[Tuple[int, slice]]:
+        for i, mmsi in enumerate(self.vessels.tolist()):
+            yield mmsi, slice(int(self.offsets[i]), int(self.offsets[i + 1]))
+
+    def take(self, idx: np.ndarray) -> "ais_messages":
+        idx = np.flatnonzero(idx) if np.asarray(idx).dtype == bool else np.sort(np.asarray(idx))
+        subset = ais_messages({name: arr[idx] for name, arr in self.columns.items()}, presorted=True)
+        subset.order = self.order[idx]
+        return subset
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return _columns_to_dataframe(self.columns)
+
+
+def _rows_to_columns(rows: List[tuple]) -> dict:
+    """
+    Transpose un lot de tuples (mmsi, lat, long, cog, sog, timestamp) en tableaux NumPy par colonne.
+    Les timestamps sont convertis en nanosecondes depuis l'epoch (UTC), les valeurs NULL en NaN.
+    """
+    mmsi, lat, long, cog, sog, timestamp = zip(*rows)
+    return {
+        "mmsi": np.asarray(mmsi, dtype=np.int64),
+        "lat": np.asarray(lat, dtype=np.float64),
+        "long": np.asarray(long, dtype=np.float64),
+        "cog": np.asarray(cog, dtype=np.float64),
+        "sog": np.asarray(sog, dtype=np.float64),
+        "timestamp": pd.to_datetime(list(timestamp), utc=True).asi8,
+    }
+
+
+def iter_points_batches(conn: psycopg2.extensions.connection, sql: str,
+                        batch_size: int = stream_batch_size) -> Iterator[dict]:
+    """
+    Exécute une requête de points via un curseur nommé (côté serveur) et renvoie les résultats par lots.
+    Seul un lot de batch_size lignes est présent en mémoire sous forme de tuples Python à un instant donné,
+    et chaque lot peut être traité pendant que les suivants sont encore en cours de transfert.
+
+    Args :
+            conn : Connexion empruntée au pool (la transaction doit rester ouverte pendant l'itération).
+            sql : Requête SELECT renvoyant (mmsi, lat, long, cog, sog, timestamp).
+            batch_size : Nombre de lignes par lot.
+
+    Returns :
+            Itérateur de dictionnaires {colonne: np.ndarray}, un par lot.
+    """
+    cur = conn.cursor(name=f"points_{uuid.uuid4().hex}")
+    cur.itersize = batch_size
+    try:
+        cur.execute(sql.strip().rstrip(";"))
+        while True:
+            batch = cur.fetchmany(batch_size)
+            if not batch:
+                break
+            yield _rows_to_columns(batch)
+    finally:
+        cur.close()
+
+
+# Format binaire de COPY : signature, puis pour chaque ligne le nombre de champs (int16)
+# et, pour chaque champ, sa longueur (int32) suivie de sa valeur. Tous les champs sont big-endian.
+_copy_signature = b"PGCOPY\n\xff\r\n\x00"
+_copy_row_dtype = np.dtype([
+    ("nb_fields", ">i2"),
+    ("len_mmsi", ">i4"), ("mmsi", ">i8"),
+    ("len_lat", ">i4"), ("lat", ">f8"),
+    ("len_long", ">i4"), ("long", ">f8"),
+    ("len_cog", ">i4"), ("cog", ">f8"),
+    ("len_sog", ">i4"), ("sog", ">f8"),
+    ("len_timestamp", ">i4"), ("timestamp", ">i8"),
+])
+# Les timestamps binaires PostgreSQL sont des microsecondes depuis le 2000-01-01.
+_pg_epoch_us = 946684800 * 1_000_000
+
+
+def copy_points_sql(sql: str) -> str:
+    """
+    Enveloppe une requête de points dans un COPY binaire dont toutes les colonnes ont une largeur fixe de 8 octets :
+    mmsi en int8, positions/cap/vitesse en float8 (NULL remplacé par NaN), timestamp inchangé (int64 en binaire).
+
+    Args :
+            sql : Requête SELECT renvoyant (mmsi, lat, long, cog, sog, timestamp).
+
+    Returns :
+            Requête COPY ... TO STDOUT WITH BINARY.
+    """
+    return f"""
+        COPY (
+            SELECT mmsi::int8,
+                   COALESCE(lat::float8, 'NaN'),
+                   COALESCE(long::float8, 'NaN'),
+                   COALESCE(cog::float8, 'NaN'),
+                   COALESCE(sog::float8, 'NaN'),
+                   timestamp
+            FROM ({sql.strip().rstrip(";")}) AS points
+            WHERE mmsi IS NOT NULL AND timestamp IS NOT NULL
+        ) TO STDOUT WITH BINARY
+        """
+
+
+def decode_copy_points(buffer) -> dict:
+    """
+    Décode la sortie d'un COPY binaire produit par copy_points_sql directement en tableaux NumPy,
+    sans créer d'objet Python par ligne (lecture du flux comme un tableau structuré à pas fixe).
+
+    Args :
+            buffer : Octets (bytes, bytearray ou memoryview) renvoyés par le COPY.
+
+    Returns :
+            Dictionnaire {colonne: np.ndarray} avec mmsi en int64, lat/long/cog/sog en float64
+            et timestamp en nanosecondes depuis l'epoch (int64).
+
+    Raises :
+            ValueError : Si le flux n'a pas le format attendu.
+    """
+    view = memoryview(buffer)
+    if bytes(view[:len(_copy_signature)]) != _copy_signature:
+        raise ValueError("Flux COPY binaire invalide : signature absente.")
+    ext_len = int.from_bytes(view[15:19], "big")
+    body = view[19 + ext_len:len(view) - 2]
+    if bytes(view[len(view) - 2:]) != b"\xff\xff" or len(body) % _copy_row_dtype.itemsize:
+        raise ValueError("Flux COPY binaire invalide : taille des lignes inattendue.")
+
+    rec = np.frombuffer(body, dtype=_copy_row_dtype)
+    lengths = [rec[name] for name in _copy_row_dtype.names if name.startswith("len_")]
+    if not ((rec["nb_fields"] == 6).all() and all((l == 8).all() for l in lengths)):
+        raise ValueError("Flux COPY binaire invalide : colonnes de largeur variable ou NULL.")
+
+    return {
+        "mmsi": rec["mmsi"].astype(np.int64),
+        "lat": rec["lat"].astype(np.float64),
+        "long": rec["long"].astype(np.float64),
+        "cog": rec["cog"].astype(np.float64),
+        "sog": rec["sog"].astype(np.float64),
+        "timestamp": (rec["timestamp"].astype(np.int64) + _pg_epoch_us) * 1000,
+    }
+
+
+def _load_points(secret_name: str, sql: str, loader: str = "fetchall") -> Union[List[tuple], pd.DataFrame, ais_messages]:
+    """
+    Exécute une requête de points sur le serveur associé à secret_name selon le mode de chargement choisi.
+
+    Args :
+            secret_name : Nom du pool à utiliser ('local', 'pgsql' ou 'vm').
+            sql : Requête SELECT renvoyant (mmsi, lat, long, cog, sog, timestamp).
+            loader : "fetchall" (liste de tuples), "stream" (curseur côté serveur, DataFrame colonne par colonne),
+                     "copy" (COPY binaire décodé directement en tableaux NumPy) ou "arrays" (COPY binaire, renvoyé en ais_messages).
+
+    Returns :
+            rows : Liste de tuples si loader == "fetchall", ais_messages si loader == "arrays",
+                   DataFrame avec les colonnes points_columns sinon.
+
+    Raises :
+            query_too_large : Si la requête dépasse statement_timeout_ms (avec l'estimation du nombre de lignes).
+    """
+    try:
+        return _execute_points(secret_name, sql, loader)
+    except psycopg2.extensions.QueryCanceledError:
+        scope = current_query_scope()
+        if scope is not None and scope.cancelled:
+            raise
+        raise query_too_large(estimate_rows(secret_name, sql))
+
+
+def _execute_points(secret_name: str, sql: str, loader: str) -> Union[List[tuple], pd.DataFrame, ais_messages]:
+    with get_pool(secret_name).connection() as conn_loc:
+        if loader in ("copy", "arrays"):
+            buffer = io.BytesIO()
+            cur_loc = conn_loc.cursor()
+            cur_loc.copy_expert(copy_points_sql(sql), buffer)
+            cur_loc.close()
+            columns = decode_copy_points(buffer.getbuffer())
+            return ais_messages(columns) if loader == "arrays" else _columns_to_dataframe(columns)
+
+        if loader == "stream":
+            builder = _columns_builder()
+            for columns in iter_points_batches(conn_loc, sql):
+                builder.append(columns)
+            return builder.to_dataframe()
+
+        cur_loc = conn_loc.cursor()
+        cur_loc.execute(sql)
+        rows = cur_loc.fetchall()
+        cur_loc.close()
+    return rows
+
+
+def _parse_mmsi_list(list_mmsi_user) -> Optional[frozenset]:
+    """
+    Convertit la liste de MMSI de l'utilisateur (chaîne "123456789,987654321" ou liste) en frozenset d'entiers.
+    Renvoie None si aucune liste n'est fournie (pas de filtre sur les MMSI).
+    """
+    if not list_mmsi_user:
+        return None
+    if isinstance(list_mmsi_user, str):
+        list_mmsi_user = list_mmsi_user.split(",")
+    return frozenset(int(mmsi) for mmsi in list_mmsi_user if str(mmsi).strip())
+
+
+def _utc(value) -> pd.Timestamp:
+    """
+    Convertit une date en pd.Timestamp UTC. Une date sans fuseau horaire est considérée comme une heure UTC
+    (et non comme une heure du fuseau de la session PostgreSQL).
+    """
+    ts = pd.Timestamp(value)
+    return ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+
+
+def points_query(date_start : datetime,
+                 date_end : datetime,
+                 min_lat : float = None,
+                 max_lat : float = None,
+                 min_long : float = None,
+                 max_long : float = None,
+                 list_mmsi_user : List[str] = None) -> dict:
+    """
+    Décrit une requête de points sous une forme comparable (table, période, zone, ensemble de MMSI),
+    utilisée par points_cache pour savoir si une requête est contenue dans une autre.
+    Les dates sans fuseau horaire sont lues en UTC : les bornes de la période (et donc des jours sélectionnés)
+    sont écrites en SQL avec un décalage explicite (+00:00) et ne dépendent pas du TimeZone de la session.
+
+    Returns :
+            Dictionnaire {table, start, end, bbox, mmsi}. bbox vaut (min_lat, max_lat, min_long, max_long) ou None,
+            mmsi vaut un frozenset d'entiers ou None.
+    """
+    return {
+        "table": bdd,
+        "start": _utc(date_start),
+        "end": _utc(date_end),
+        "bbox": (min_lat, max_lat, min_long, max_long) if min_lat is not None else None,
+        "mmsi": _parse_mmsi_list(list_mmsi_user),
+    }
+
+
+def _selection_contains(outer: dict, inner: dict) -> bool:
+    if outer["table"] != inner["table"]:
+        return False
+    if outer["bbox"] is not None:
+        if inner["bbox"] is None:
+            return False
+        o_min_lat, o_max_lat, o_min_long, o_max_long = outer["bbox"]
+        i_min_lat, i_max_lat, i_min_long, i_max_long = inner["bbox"]
+        if not (o_min_lat <= i_min_lat and i_max_lat <= o_max_lat and o_min_long <= i_min_long and i_max_long <= o_max_long):
+            return False
+    if outer["mmsi"] is not None:
+        if inner["mmsi"] is None or not inner["mmsi"] <= outer["mmsi"]:
+            return False
+    return True
+
+
+def query_days(query: dict) -> pd.DatetimeIndex:
+    """
+    Renvoie les jours (UTC, à minuit) couverts par la période d'une requête, bornes incluses.
+    """
+    return pd.date_range(query["start"].floor("D"), query["end"].floor("D"), freq="D")
+
+
+def day_runs(days) -> List[Tuple[pd.Timestamp, pd.Timestamp]]:
+    """
+    Regroupe une liste de jours en plages contiguës [premier jour ; lendemain du dernier jour[.
+
+    Args :
+            days : Jours (pd.Timestamp à minuit).
+
+    Returns :
+            Liste de tuples (début inclus, fin exclue).
+    """
+    runs: list = []
+    for day in sorted(days):
+        if runs and runs[-1][1] == day:
+            runs[-1] = (runs[-1][0], day + pd.Timedelta(days=1))
+        else:
+            runs.append((day, day + pd.Timedelta(days=1)))
+    return runs
+
+
+def points_sql(query: dict, start: pd.Timestamp = None, end_exclusive: pd.Timestamp = None,
+               sample_rate: float = None, cell_deg: float = None) -> str:
+    """
+    Construit la requête SELECT des points d'une sélection (zone et/ou MMSI) décrite par points_query.
+
+    Args :
+            query : Requête décrite par points_query.
+            start : Début de la période (inclus). Par défaut, le début de la requête.
+            end_exclusive : Fin de la période (exclue). Par défaut, la période se termine à la fin de la requête (incluse).
+            sample_rate : Si fourni, proportion (entre 0 et 1) de messages conservés par la base.
+                          Le tirage dépend d'un hash de (mmsi, timestamp) : il est reproductible d'une requête à l'autre.
+            cell_deg : Si fourni, taille (en degrés) des cellules de la grille d'agrégation : la base ne renvoie
+                       que le dernier message de chaque navire dans chaque cellule.
+
+    Returns :
+            Requête SQL renvoyant (mmsi, lat, long, cog, sog, timestamp).
+    """
+    start = query["start"] if start is None else start
+    filters = f"""timestamp >= '{start.isoformat()}'"""
+    if end_exclusive is None:
+        filters += f"""
+            AND timestamp <= '{query["end"].isoformat()}'"""
+    else:
+        filters += f"""
+            AND timestamp < '{end_exclusive.isoformat()}'"""
+    if query["bbox"] is not None:
+        min_lat, max_lat, min_long, max_long = query["bbox"]
+        filters += f"""
+            AND lat BETWEEN {min_lat} AND {max_lat}
+            AND long BETWEEN {min_long} AND {max_long}"""
+    if query["mmsi"] is not None:
+        filters += f"""
+            AND mmsi IN ({','.join(map(str, sorted(query["mmsi"])))})"""
+    if sample_rate is not None:
+        filters += f"""
+            AND (hashtext(mmsi::text || timestamp::text) & 2147483647) % 1000000 < {int(round(sample_rate * 1000000))}"""
+
+    if cell_deg is not None:
+        return f"""
+          SELECT DISTINCT ON (mmsi, floor(lat / {cell_deg}), floor(long / {cell_deg}))
+                 mmsi, lat, long, cog, sog, timestamp
+          FROM {query["table"]}
+          WHERE {filters}
+          ORDER BY mmsi, floor(lat / {cell_deg}), floor(long / {cell_deg}), timestamp DESC
+          """
+
+    return f"""
+          SELECT mmsi, lat, long, cog, sog, timestamp
+          FROM {query["table"]}
+          WHERE {filters}
+          """
+
+
+def filter_points(df: pd.DataFrame, query: dict) -> pd.DataFrame:
+    """
+    Applique en mémoire les filtres d'une requête (période, zone, MMSI) à un DataFrame de points.
+
+    Args :
+            df : DataFrame avec les colonnes points_columns (timestamp en UTC).
+            query : Requête décrite par points_query.
+
+    Returns :
+            Copie filtrée de df.
+    """
+    mask = (df["timestamp"] >= query["start"]) & (df["timestamp"] <= query["end"])
+    if query["bbox"] is not None:
+        min_lat, max_lat, min_long, max_long = query["bbox"]
+        mask &= df["lat"].between(min_lat, max_lat) & df["long"].between(min_long, max_long)
+    if query["mmsi"] is not None:
+        mask &= df["mmsi"].isin(query["mmsi"])
+    return df[mask].reset_index(drop=True)
+
+
+def split_by_day(df: pd.DataFrame, days) -> dict:
+    """
+    Découpe un DataFrame de points en partitions journalières (UTC), triées par timestamp.
+    Les jours sans message donnent une partition vide, pour ne pas être redemandés à la base.
+
+    Args :
+            df : DataFrame avec les colonnes points_columns.
+            days : Jours (pd.Timestamp à minuit, UTC) couverts par df.
+
+    Returns :
+            Dictionnaire {jour: DataFrame}.
+    """
+    df = df.sort_values("timestamp", kind="stable").reset_index(drop=True)
+    # Comparaison en nanosecondes depuis l'epoch (int64) : to_numpy() sur des dates avec fuseau renverrait des objets pd.Timestamp
+    timestamps = pd.DatetimeIndex(df["timestamp"]).asi8
+    days = pd.DatetimeIndex(sorted(days))
+    bounds = np.searchsorted(timestamps, days.append(days[-1:] + pd.Timedelta(days=1)).asi8, side="left")
+    return {day: df.iloc[bounds[i]:bounds[i + 1]].reset_index(drop=True) for i, day in enumerate(days)}
+
+
+class points_cache():
+    """
+    Cache sémantique et incrémental des résultats de get_points, partagé par toutes les sessions.
+
+    Chaque sélection (table, zone, liste de MMSI) garde ses résultats découpés en partitions journalières.
+    Une requête est servie sans accès à la base si une sélection qui la contient (zone plus grande,
+    liste de MMSI plus large) possède déjà tous les jours demandés : les partitions sont concaténées puis filtrées en mémoire.
+    Sinon, seuls les jours manquants de la sélection exacte sont demandés à la base (missing_days / store_days),
+    ce qui transforme l'extension de la plage temporelle en petites requêtes sur les nouveaux jours.
+    Les sélections les moins récemment utilisées sont supprimées quand la taille totale dépasse max_bytes.
+
+    Attributes:
+        max_bytes (int): Taille mémoire maximale du cache, en octets.
+        nbytes (int): Taille mémoire actuelle du cache, en octets.
+
+    Methods:
+        lookup(query) -> Optional[pd.DataFrame]:
+            Renvoie le résultat filtré d'une sélection contenant la requête et couvrant tous ses jours, ou None.
+
+        lookup_covers(query) -> bool:
+            Indique si lookup(query) répondrait sans accès à la base.
+
+        missing_days(query) -> List[pd.Timestamp]:
+            Renvoie les jours de la requête absents de la sélection exacte.
+
+        cached_days(query) -> dict:
+            Renvoie les partitions journalières de la requête déjà présentes dans la sélection exacte.
+
+        store_days(query, days, df) -> bool:
+            Ajoute les partitions journalières d'un résultat couvrant les jours days, indique si elles ont été gardées.
+
+        clear():
+            Vide le cache.
+    """
+    def __init__(self, max_bytes: int = points_cache_max_bytes):
+        """
+        Initialise un cache vide.
+
+        Args:
+            max_bytes (int): Taille mémoire maximale du cache, en octets.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(query: dict) -> tuple:
+        return (query["table"], query["bbox"], query["mmsi"])
+
+    def lookup(self, query: dict) -> Optional[pd.DataFrame]:
+        """
+        Cherche une sélection contenant la requête et possédant tous ses jours, et filtre ses partitions en mémoire.
+
+        Args:
+            query (dict): Requête décrite par points_query.
+
+        Returns:
+            Optional[pd.DataFrame]: Résultat filtré (copie), ou None si aucune sélection ne peut répondre.
+        """
+        days = query_days(query)
+        with self._lock:
+            for key, entry in self._entries.items():
+                if _selection_contains(entry["query"], query) and all(day in entry["days"] for day in days):
+                    self._entries.move_to_end(key)
+                    partitions = [entry["days"][day] for day in days]
+                    break
+            else:
+                return None
+        return filter_points(pd.concat(partitions, ignore_index=True), query)
+
+    def lookup_covers(self, query: dict) -> bool:
+        """
+        Indique si une sélection en cache contient la requête et possède tous ses jours (sans filtrer les données).
+
+        Args:
+            query (dict): Requête décrite par points_query.
+
+        Returns:
+            bool: True si lookup(query) répondrait sans accès à la base.
+        """
+        days = query_days(query)
+        with self._lock:
+            return any(
+                _selection_contains(entry["query"], query) and all(day in entry["days"] for day in days)
+                for entry in self._entries.values()
+            )
+
+    def missing_days(self, query: dict) -> List[pd.Timestamp]:
+        """
+        Renvoie les jours de la requête qui ne sont pas encore en cache pour sa sélection exacte.
+
+        Args:
+            query (dict): Requête décrite par points_query.
+
+        Returns:
+            List[pd.Timestamp]: Jours manquants (à minuit, UTC).
+        """
+        with self._lock:
+            entry = self._entries.get(self._key(query))
+            cached = entry["days"] if entry is not None else {}
+            return [day for day in query_days(query) if day not in cached]
+
+    def cached_days(self, query: dict) -> dict:
+        """
+        Renvoie les partitions journalières de la requête déjà présentes dans sa sélection exacte.
+        Les partitions restent utilisables même si la sélection est évincée ensuite.
+
+        Args:
+            query (dict): Requête décrite par points_query.
+
+        Returns:
+            dict: {jour: DataFrame} pour les jours de la requête en cache.
+        """
+        with self._lock:
+            entry = self._entries.get(self._key(query))
+            cached = entry["days"] if entry is not None else {}
+            return {day: cached[day] for day in query_days(query) if day in cached}
+
+    def store_days(self, query: dict, days, df: pd.DataFrame) -> bool:
+        """
+        Ajoute à la sélection de la requête les partitions journalières d'un résultat.
+
+        Args:
+            query (dict): Requête décrite par points_query (seule la sélection est utilisée).
+            days: Jours entièrement couverts par df.
+            df (pd.DataFrame): Points de la sélection sur ces jours.
+
+        Returns:
+            bool: False si la sélection a été évincée aussitôt (résultat plus grand que max_bytes).
+        """
+        partitions = split_by_day(df, days)
+
+        with self._lock:
+            key = self._key(query)
+            entry = self._entries.setdefault(key, {"query": query, "days": {}, "nbytes": 0})
+            nbytes = 0
+            for day, partition in partitions.items():
+                if day not in entry["days"]:
+                    entry["days"][day] = partition
+                    nbytes += int(partition.memory_usage(index=True, deep=True).sum())
+            entry["nbytes"] += nbytes
+            self.nbytes += nbytes
+            self._entries.move_to_end(key)
+
+            while self.nbytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted["nbytes"]
+            return key in self._entries
+
+    def clear(self) -> None:
+        """
+        Vide le cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+@st.cache_resource
+def get_points_cache() -> points_cache:
+    """
+    Renvoie le cache sémantique de points du processus, partagé entre toutes les sessions (st.cache_resource).
+
+    Returns:
+        points_cache : Cache des résultats de get_points.
+    """
+    return points_cache()
+
+
+def auto_shard_count(nb_days: int) -> int:
+    """
+    Choisit le nombre de morceaux d'une requête de points en fonction du nombre de jours couverts :
+    un morceau par tranche de shard_min_days jours, dans la limite de shard_max_count.
+    """
+    return int(max(1, min(shard_max_count, math.ceil(nb_days / shard_min_days))))
+
+
+def fetch_points_sharded(query: dict, days, loader: str = "copy",
+                         shard_count: int = None) -> List[Tuple[pd.DatetimeIndex, pd.DataFrame]]:
+    """
+    Récupère les points d'une sélection sur une liste de jours en découpant la période en shard_count morceaux
+    exécutés en parallèle, chacun sur sa propre connexion du pool. Le serveur peut ainsi utiliser plusieurs cœurs
+    pour une même requête interactive. Le parallélisme est borné pour tout le processus (fetch_parallel_slots) :
+    quand d'autres sessions l'utilisent déjà, les morceaux sont exécutés à la suite.
+
+    Args :
+            query : Requête décrite par points_query (seule la sélection est utilisée).
+            days : Jours à récupérer (pd.Timestamp à minuit, UTC), pas forcément contigus.
+            loader : Mode de chargement ("stream" ou "copy").
+            shard_count : Nombre de morceaux. Par défaut, choisi par auto_shard_count.
+
+    Returns :
+            Liste de (jours couverts, DataFrame des points de ces jours) par plage contiguë, dans l'ordre chronologique.
+    """
+    days = sorted(days)
+    if not days:
+        return []
+    if shard_count is None:
+        shard_count = auto_shard_count(len(days))
+    shard_count = max(1, min(shard_count, len(days)))
+
+    def fetch_shard(shard_days) -> list:
+        results = []
+        for run_start, run_end in day_runs(shard_days):
+            run_days = pd.date_range(run_start, run_end - pd.Timedelta(days=1), freq="D")
+            results.append((run_days, _load_points("local", points_sql(query, run_start, run_end), loader)))
+        return results
+
+    shards = [list(shard) for shard in np.array_split(np.array(days, dtype=object), shard_count) if len(shard)]
+    if len(shards) == 1:
+        return fetch_shard(shards[0])
+
+    with fetch_executor(len(shards), "local") as executor:
+        futures = [executor.submit(fetch_shard, shard) for shard in shards]
+        return [result for future in futures for result in future.result()]
+
+
 @st.cache_data
+def _get_points_rows(sql: str) -> List[tuple]:
+    return _load_points("local", sql, "fetchall")
+
+
+@st.cache_data
+def _get_planned_points(sql: str, loader: str) -> pd.DataFrame:
+    return _load_points("local", sql, loader)
+
+       
+@cancellable
 def get_points(date_start : datetime, 
                date_end : datetime, 
                min_lat : float = None, 
                max_lat : float = None, 
                min_long : float = None, 
                max_long : float = None, 
-               list_mmsi_user : List[str] = None) -> List[tuple]:
+               list_mmsi_user : List[str] = None,
+               loader : str = "fetchall",
+               shard_count : int = None,
+               plan : dict = None,
+               sample_size : int = None) -> Union[List[tuple], pd.DataFrame]:
     """
     Récupère toutes les données filtrées par les arguments dans la base de données utilisée pour la visualisation.
     L'utilisateur a le choix de choisir une zone ou une liste de navire (MMSI) individuellent, ou les deux.
+    En mode "stream" ou "copy", les résultats passent par le cache sémantique (get_points_cache) :
+    une requête contenue dans une requête déjà exécutée (zone plus petite, période plus courte...) est servie sans accès à la base,
+    et seuls les jours pas encore récupérés pour la même zone / liste de MMSI sont demandés quand la période s'étend.
 
     Args :
             date_start : Date de début du filtre au format YYYY-MM-DD.
@@ -85,9 +1333,18 @@ def get_points(date_start : datetime,
             min_long : Longitude minimum. (limite ouest)
             max_long : Longitude maximum (limite est)
             list_mmsi_user : Liste des MMSI des navires d'intérêt.
+            loader : "fetchall" pour une liste de tuples, "stream" pour un chargement par lots (curseur côté serveur) en DataFrame,
+                     "copy" pour un COPY binaire décodé en colonnes NumPy.
+            shard_count : Nombre de morceaux temporels exécutés en parallèle ("stream" et "copy" uniquement).
+                          Par défaut, choisi selon la durée de la période (auto_shard_count).
+            plan : Plan renvoyé par plan_points_query ("stream" et "copy" uniquement). Si le plan est un échantillonnage
+                   ou une agrégation, la requête correspondante est exécutée à la place de la requête complète.
+            sample_size : Nombre maximum de messages renvoyés ("stream" et "copy" uniquement). Associé à un plan
+                          plan_points_query(..., sample_size=sample_size), seuls environ sample_size messages sont transférés.
     
     Returns :
-            rows : Liste de lignes organisées dans un tuple(mmsi, lat, long, cog, sog, timestamp)
+            rows : Liste de lignes organisées dans un tuple(mmsi, lat, long, cog, sog, timestamp),
+                   ou DataFrame avec les mêmes colonnes si loader vaut "stream" ou "copy", trié par timestamp.
     
     """
     choice : int = 2
@@ -115,52 +1372,187 @@ def get_points(date_start : datetime,
             and mmsi in ({list_mmsi_user});
           """
     
-    if min_lat is not None and list_mmsi_user is None:
+    if min_lat is not None and not list_mmsi_user:
         choice = 1
     elif list_mmsi_user and min_lat is None:
         choice = 0
  
+    if loader == "fetchall":
+        return _get_points_rows(sql_list[choice])
+
+    query = points_query(date_start, date_end, min_lat, max_lat, min_long, max_long, list_mmsi_user)
+    if plan is not None and plan.get("replan") is not None and not get_points_cache().lookup_covers(query):
+        # Les jours en cache lors de la planification ont été évincés depuis : le plan est recalculé d'après la base,
+        # et mis à jour sur place pour que l'appelant affiche le plan réellement exécuté.
+        # Le plan n'est modifié qu'une fois le nouveau calculé : le premier essai de run_cancellable doit rester sans effet
+        new_plan = _plan_points_query(*plan["replan"])
+        plan.update(new_plan)
+        plan.pop("replan")
+    if plan is not None and plan["mode"] != "full":
+        df = _get_planned_points(points_sql(query, sample_rate=plan["sample_rate"], cell_deg=plan["cell_deg"]), loader)
+    else:
+        df = _get_full_points(query, loader, shard_count)
+
+    if sample_size is not None and len(df) > sample_size:
+        df = df.sample(sample_size, random_state=42).sort_values("timestamp", kind="stable").reset_index(drop=True)
+    return df
+
+
+def _get_full_points(query: dict, loader: str, shard_count: int = None) -> pd.DataFrame:
+    cache = get_points_cache()
+    df = cache.lookup(query)
+    if df is not None:
+        return df
+
+    cached = cache.cached_days(query)
+    missing = [day for day in query_days(query) if day not in cached]
+    fetched = fetch_points_sharded(query, missing, loader, shard_count)
+    kept = [cache.store_days(query, days, df_days) for days, df_days in fetched]
+
+    if all(kept):
+        df = cache.lookup(query)
+        if df is not None:
+            return df
+
+    # Résultat plus grand que le cache : il est reconstitué à partir des partitions déjà en mémoire
+    # et des jours qui viennent d'être récupérés, sans nouvelle requête
+    frames = list(cached.values()) + [df_days for _, df_days in fetched]
+    return filter_points(pd.concat(frames, ignore_index=True).sort_values("timestamp", kind="stable"), query)
     
-    conn_loc = connect_pgsql_bigdata()
-    cur_loc = conn_loc.cursor()
-    cur_loc.execute(sql_list[choice])
-    rows = cur_loc.fetchall()
-    cur_loc.close()
-    conn_loc.close()
-    return rows
-    
+@cancellable
 @st.cache_data
-def get_points_with_traj(date_start : datetime,
-                date_end : datetime, 
-                date_start_2 : datetime = None, 
-                date_end_2 : datetime = None,
-                min_lat : float = None , 
-                max_lat : float = None, 
-                min_long : float = None,
-                max_long : float = None, 
-                list_mmsi_user : List[str]=None) -> List[tuple]:
+def get_points_counts(date_start : datetime,
+                      date_end : datetime,
+                      min_lat : float = None,
+                      max_lat : float = None,
+                      min_long : float = None,
+                      max_long : float = None,
+                      list_mmsi_user : List[str] = None) -> pd.DataFrame:
     """
-    Récupère toutes les données filtrées par les arguments dans la base de données utilisée pour la visualisation.
-    L'utilisateur a le choix de choisir une zone ou une liste de navire (MMSI).
-    Si l'utilisateur choisi une zone, il doit aussi fournir une deuxième plage temporelle,
-    pour choisir la période de récupération des points déjà filtrés par la première plage. (qui étaient dans la zone sélectionnée pendant la période [date_start;date_end] )
+    Compte les messages de chaque navire correspondant aux filtres, sans transférer les messages.
+    Permet d'afficher le nombre réel de messages et de MMSI quand seul un échantillon est récupéré.
 
     Args :
-            date_start : Date de début du filtre sii list_mmsi_user is not None. Dans l'autre cas, c'est la plage temporelle pour sélectionner les points passant par une zone. au format YYYY-MM-DD
-            date_end : Date de findu filtre sii list_mmsi_user is not None. Dans l'autre cas, c'est la plage temporelle pour sélectionner les points passant par une zone. au format YYYY-MM-DD
-            date_start_2 : Date de début du second filtre. Permet de choisir l'intervalle temporelle, 
-            pour observer les points qui étaient dans la zone sélectionner pendant la période [date_start;date_end]. au format YYYY-MM-DD
-            date_end_2 : Date de fin du second filtre. Permet de choisir l'intervalle temporelle, 
-            pour observer les points qui étaient dans la zone sélectionner pendant la période [date_start;date_end]. au format YYYY-MM-DD
-            min_lat : Latitude minimum de la zone de passage. (limite sud)
-            max_lat : Latitude maximum de la zone de passage. (limite nord)
-            min_long : Longitude minimum de la zone de passage. (limite ouest)
-            max_long : Longitude maximum de la zone de passage. (limite est)
-            list_mmsi_user : Liste des MMSI des navires d'intérêt.
-    
+            Voir get_points.
+
     Returns :
-            rows : Liste de lignes organisées dans un tuple(mmsi, lat, long, cog, sog, timestamp)
-    
+            DataFrame avec les colonnes mmsi et count (un navire par ligne).
+    """
+    query = points_query(date_start, date_end, min_lat, max_lat, min_long, max_long, list_mmsi_user)
+    df = get_points_cache().lookup(query)
+    if df is not None:
+        return df["mmsi"].value_counts().rename_axis("mmsi").reset_index(name="count")
+
+    sql_get = f"""
+          SELECT mmsi, count(*)
+          FROM ({points_sql(query)}) AS points
+          GROUP BY mmsi
+          """
+    with get_pool("local").connection() as conn_loc:
+        cur_loc = conn_loc.cursor()
+        cur_loc.execute(sql_get)
+        rows = cur_loc.fetchall()
+        cur_loc.close()
+    return pd.DataFrame(rows, columns=["mmsi", "count"])
+
+
+@cancellable
+def plan_points_query(date_start : datetime,
+                      date_end : datetime,
+                      min_lat : float = None,
+                      max_lat : float = None,
+                      min_long : float = None,
+                      max_long : float = None,
+                      list_mmsi_user : List[str] = None,
+                      row_budget : int = planner_row_budget,
+                      sample_size : int = None) -> dict:
+    """
+    Estime la taille du résultat d'une requête de points avant de l'exécuter (EXPLAIN), et choisit comment la récupérer :
+    - "full" : tous les messages, si l'estimation tient dans row_budget (ou si les données sont déjà en cache) ;
+    - "sample" : échantillon reproductible tiré par la base, si l'estimation dépasse row_budget d'au plus planner_sample_max_factor fois ;
+    - "aggregate" : dernier message de chaque navire par cellule de grille, au-delà.
+    Si sample_size est fourni, l'échantillon est dimensionné d'après l'estimation pour renvoyer environ sample_size messages
+    (sans compter exactement les messages de la sélection).
+    Le plan est à passer à get_points.
+
+    Args :
+            Voir get_points.
+            row_budget : Nombre maximum de lignes à transférer.
+            sample_size : Nombre de messages souhaité (échantillon tiré par la base).
+
+    Returns :
+            plan : Dictionnaire {mode, estimated_rows, sample_rate, cell_deg, label}. Un plan "en cache" contient aussi
+                   replan, les arguments de _plan_points_query, pour que get_points le recalcule si les jours ont été évincés.
+    """
+    # L'état du cache change d'un appel à l'autre : ce test n'est jamais mis en cache par Streamlit
+    query = points_query(date_start, date_end, min_lat, max_lat, min_long, max_long, list_mmsi_user)
+    if get_points_cache().lookup_covers(query):
+        return {"mode": "full", "estimated_rows": None, "sample_rate": None, "cell_deg": None,
+                "label": "Tous les messages (en cache)",
+                "replan": (date_start, date_end, min_lat, max_lat, min_long, max_long, list_mmsi_user, row_budget, sample_size)}
+    return _plan_points_query(date_start, date_end, min_lat, max_lat, min_long, max_long, list_mmsi_user, row_budget, sample_size)
+
+@cancellable
+@st.cache_data
+def _plan_points_query(date_start : datetime,
+                       date_end : datetime,
+                       min_lat : float = None,
+                       max_lat : float = None,
+                       min_long : float = None,
+                       max_long : float = None,
+                       list_mmsi_user : List[str] = None,
+                       row_budget : int = planner_row_budget,
+                       sample_size : int = None) -> dict:
+    """
+    Plan de plan_points_query d'après la base seule (estimation EXPLAIN), sans tenir compte du cache de points.
+    """
+    query = points_query(date_start, date_end, min_lat, max_lat, min_long, max_long, list_mmsi_user)
+    plan = {"mode": "full", "estimated_rows": None, "sample_rate": None, "cell_deg": None, "label": "Tous les messages"}
+
+    estimated = estimate_rows("local", points_sql(query))
+    plan["estimated_rows"] = estimated
+
+    if sample_size is not None:
+        if estimated is not None and estimated > sample_size:
+            plan["mode"] = "sample"
+            plan["sample_rate"] = min(1.0, sample_oversampling * sample_size / estimated)
+            plan["label"] = f"Échantillon d'environ {sample_size} messages sur ~{estimated} (base de données)"
+        return plan
+
+    if estimated is None or estimated <= row_budget:
+        return plan
+
+    if estimated <= row_budget * planner_sample_max_factor:
+        plan["mode"] = "sample"
+        plan["sample_rate"] = row_budget / estimated
+        plan["label"] = f"Échantillon de {plan['sample_rate']:.1%} des messages (base de données)"
+        return plan
+
+    if query["bbox"] is not None:
+        min_lat, max_lat, min_long, max_long = query["bbox"]
+        cell_deg = math.sqrt(max((max_lat - min_lat) * (max_long - min_long), 1e-6) / row_budget)
+    else:
+        cell_deg = planner_default_cell_deg
+    plan["mode"] = "aggregate"
+    plan["cell_deg"] = round(max(cell_deg, 1e-4), 5)
+    plan["label"] = f"Dernier message par navire et par cellule de {plan['cell_deg']}° (base de données)"
+    return plan
+
+
+def traj_sql(date_start : datetime,
+             date_end : datetime,
+             date_start_2 : datetime = None,
+             date_end_2 : datetime = None,
+             min_lat : float = None,
+             max_lat : float = None,
+             min_long : float = None,
+             max_long : float = None,
+             list_mmsi_user : List[str] = None) -> str:
+    """
+    Construit la requête du mode trajectoire (voir get_traj_bundle pour la signification des arguments).
+
+    Returns :
+            Requête SQL renvoyant (mmsi, lat, long, cog, sog, timestamp).
     """
     choice : int  = 2
 
@@ -200,27 +1592,74 @@ def get_points_with_traj(date_start : datetime,
         AND timestamp <= '{date_end_2}'
         """
     
-    if min_lat is not None and list_mmsi_user is None:
+    if min_lat is not None and not list_mmsi_user:
         choice = 1
     elif list_mmsi_user and min_lat is None:
         choice = 0
 
-    conn_loc = connect_pgsql_bigdata()
-    cur_loc = conn_loc.cursor()
-    cur_loc.execute(sql_tuple[choice])
-    rows = cur_loc.fetchall()
-    cur_loc.close()
-    conn_loc.close()
-    return rows
+    return sql_tuple[choice]
+
+def _last_points_filters(date_end, min_lat, max_lat, min_long, max_long, list_mmsi_user, lookback_days) -> str:
+    date_start = date_end - timedelta(days=lookback_days)
+
+    filters = f"""timestamp >= '{date_start}'
+            AND timestamp <= '{date_end}'"""
+    if min_lat is not None:
+        filters += f"""
+            AND lat BETWEEN {min_lat} AND {max_lat}
+            AND long BETWEEN {min_long} AND {max_long}"""
+    if list_mmsi_user:
+        filters += f"""
+            AND mmsi IN ({list_mmsi_user})"""
+    return filters
+
+
+@cancellable
+@st.cache_data
+def get_last_points(date_end : datetime,
+                    min_lat : float = None,
+                    max_lat : float = None,
+                    min_long : float = None,
+                    max_long : float = None,
+                    list_mmsi_user : List[str] = None,
+                    lookback_days : int = snapshot_lookback_days,
+                    loader : str = "copy") -> Union[List[tuple], pd.DataFrame]:
+    """
+    Récupère le dernier message de chaque navire (MMSI) émis dans la zone et/ou la liste de MMSI,
+    sur la période [date_end - lookback_days ; date_end]. Le dédoublonnage est fait par la base (DISTINCT ON),
+    seule une ligne par navire est donc transférée.
+
+    Args :
+            date_end : Date et heure de la photo.
+            min_lat : Latitude minimum. (limite sud)
+            max_lat : Latitude maximum. (limite nord)
+            min_long : Longitude minimum. (limite ouest)
+            max_long : Longitude maximum (limite est)
+            list_mmsi_user : Liste des MMSI des navires d'intérêt.
+            lookback_days : Nombre de jours avant date_end dans lesquels chercher le dernier message.
+            loader : Mode de chargement ("fetchall", "stream" ou "copy"), voir get_points.
 
-def create_all_df(rows: List[tuple]) -> Tuple[pd.DataFrame, pd.DataFrame, set[str]]:
+    Returns :
+            rows : Une ligne (mmsi, lat, long, cog, sog, timestamp) par navire, en liste de tuples ou en DataFrame selon loader.
+    """
+    filters = _last_points_filters(date_end, min_lat, max_lat, min_long, max_long, list_mmsi_user, lookback_days)
+
+    sql_get = f"""
+          SELECT DISTINCT ON (mmsi) mmsi, lat, long, cog, sog, timestamp
+          FROM {bdd}
+          WHERE {filters}
+          ORDER BY mmsi, timestamp DESC
+          """
+    return _load_points("local", sql_get, loader)
+
+def create_all_df(rows: Union[List[tuple], pd.DataFrame, ais_messages]) -> Tuple[pd.DataFrame, pd.DataFrame, set[int]]:
     """
     Récupère la liste de tuple (de la base de données) pour la transformer en DataFrame pandas.
     Crée une autre DataFrame à partir des données IHS et merge (left outer) pour obtenir un DF complet.
     Récupère la liste des MMSI de tous les navires présents.
 
     Args :
-            rows : Liste de lignes organisées dans un tuple(mmsi, lat, long, cog, sog, timestamp)
+            rows : Liste de lignes organisées dans un tuple(mmsi, lat, long, cog, sog, timestamp), DataFrame avec ces colonnes ou ais_messages.
     
     Returns :
             df_ihs : DataFrame avec les données statiques (nom, dimensions...) ainsi que les types IHS si disponibles.
@@ -229,16 +1668,78 @@ def create_all_df(rows: List[tuple]) -> Tuple[pd.DataFrame, pd.DataFrame, set[st
     
     """
 
-    df_1=pd.DataFrame(rows, columns=["mmsi","lat", "long","cog","sog", "timestamp"])
+    df_1=compact_points(_points_dataframe(rows))
     df_ihs=get_ihs(df_1)
-    df_1['mmsi'] = df_1['mmsi'].astype(str)
-    df_ihs['mmsi'] = df_ihs['mmsi'].astype(str)
     df = pd.merge(df_1, df_ihs, on='mmsi', how='left')
-    set_mmsi = set(df['mmsi'].unique())
+    set_mmsi = set(df['mmsi'].unique().tolist())
 
     return df_ihs, df, set_mmsi
 
-def create_all_df_screen(rows: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame, set[str]]:
+def create_vessels_df(df_counts: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Crée le DataFrame des navires d'une sélection (une ligne par MMSI) à partir de get_points_counts,
+    pour la liste des MMSI et les graphiques quand seul un échantillon des messages a été récupéré.
+
+    Args :
+            df_counts : DataFrame avec les colonnes mmsi et count (get_points_counts).
+
+    Returns :
+            df_ihs : DataFrame avec les données statiques et les types IHS des navires de la sélection.
+            df : DataFrame des navires (mmsi, count et données IHS).
+    """
+    df_counts = df_counts.astype({"mmsi": np.int64, "count": np.int64})
+    df_ihs = get_ihs(df_counts)
+    df = pd.merge(df_counts, df_ihs, on='mmsi', how='left')
+    return df_ihs, df
+
+def session_memo(name: str, key: tuple, compute: Callable) -> object:
+    """
+    Mémorise dans st.session_state le résultat d'une étape de calcul de la page (une entrée par nom),
+    recalculé seulement quand la clé change (requête, filtres...). Contrairement à st.cache_data,
+    le résultat n'est ni haché ni copié à chaque rerun : les DataFrames de plusieurs millions de lignes
+    restent en mémoire tels quels pour la session.
+
+    Args :
+            name : Nom de l'étape (ex: "messages").
+            key : Paramètres dont dépend le résultat.
+            compute : Fonction sans argument qui calcule le résultat.
+
+    Returns :
+            Résultat de compute, éventuellement mémorisé lors d'un rerun précédent.
+    """
+    slot = st.session_state.get(f"memo_{name}")
+    if slot is None or slot[0] != key:
+        slot = (key, compute())
+        st.session_state[f"memo_{name}"] = slot
+    return slot[1]
+
+def _points_dataframe(rows: Union[List[tuple], pd.DataFrame, ais_messages]) -> pd.DataFrame:
+    if isinstance(rows, ais_messages):
+        return rows.to_dataframe()
+    return rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows, columns=points_columns)
+
+def compact_points(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convertit les messages AIS en types compacts (voir points_dtypes) : MMSI entier, coordonnées, cap et vitesse en float32.
+    Le timestamp est converti en datetime64 s'il ne l'est pas déjà (stocké en entier 64 bits), en heure UTC sans
+    fuseau horaire (les pages de graphiques et make_dataframe attendent des dates naïves). Les heures affichées
+    (infobulles, graphiques) sont donc en UTC, même si la session PostgreSQL utilise un autre fuseau.
+    Le DataFrame d'origine (éventuellement partagé par le cache) n'est pas modifié.
+
+    Args :
+            df : DataFrame avec les colonnes de points_columns.
+
+    Returns :
+            DataFrame avec les mêmes colonnes, typées.
+    """
+    df = df.astype(points_dtypes)
+    if not pd.api.types.is_datetime64_any_dtype(df['timestamp']):
+        df['timestamp'] = pd.to_datetime(df['timestamp'])
+    if df['timestamp'].dt.tz is not None:
+        df['timestamp'] = df['timestamp'].dt.tz_convert("UTC").dt.tz_localize(None)
+    return df
+
+def create_all_df_screen(rows: Union[List[tuple], pd.DataFrame, ais_messages]) -> Tuple[pd.DataFrame, pd.DataFrame, set[int]]:
     """
     Récupère la liste de tuple (de la base de données) pour la transformer en DataFrame pandas.
     Trie les lignes dans l'ordre chronologique décroissant pour récupérer le dernier message reçu pour chaque MMSI.
@@ -246,7 +1747,7 @@ def create_all_df_screen(rows: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame
     Récupère la liste des MMSI de tous les navires présents.
 
     Args :
-            rows : Liste de lignes organisées dans un tuple(mmsi, lat, long, cog, sog, timestamp)
+            rows : Liste de lignes organisées dans un tuple(mmsi, lat, long, cog, sog, timestamp), DataFrame avec ces colonnes ou ais_messages.
     
     Returns :
             df_ihs : DataFrame avec les données statiques (nom, dimensions...) ainsi que les types IHS si disponibles.
@@ -254,18 +1755,17 @@ def create_all_df_screen(rows: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame
             set_mmsi : set des MMSI des navires. (unordered, unique)
     
     """
-    df_1 = pd.DataFrame(rows, columns=["mmsi","lat", "long","cog","sog","timestamp"])
-    df_1['timestamp'] = pd.to_datetime(df_1['timestamp']).dt.tz_localize(None)
+    df_1 = compact_points(_points_dataframe(rows))
     df_sorted_1=df_1.sort_values(by='timestamp', ascending=False).groupby('mmsi').first().reset_index()
     df_sorted=df_sorted_1
     
     df_ihs=get_ihs(df_sorted)
     df = pd.merge(df_sorted, df_ihs, on='mmsi', how='left')
-    set_mmsi = set(df['mmsi'].unique())
+    set_mmsi = set(df['mmsi'].unique().tolist())
 
     return df_ihs, df, set_mmsi
 
-def per_mmsi_filter(df_complete: pd.DataFrame, set_mmsi: set, df_display: pd.DataFrame) -> pd.DataFrame:
+def per_mmsi_filter(df_complete: pd.DataFrame, set_mmsi: set, df_display: pd.DataFrame, messages: ais_messages = None) -> pd.DataFrame:
     """
     Filtre les messages affichés sur la carte pour chaque MMSI, dans le cas où l'utilisateur a rentré manuellement une liste de MMSI.
     Permet de choisir combien de messages sont affichés par navire via des sliders.
@@ -274,6 +1774,8 @@ def per_mmsi_filter(df_complete: pd.DataFrame, set_mmsi: set, df_display: pd.Dat
         df_complete : DataFrame de toutes les données disponibles
         set_mmsi : set des MMSI fournis par l'utilisateur.
         df_display : DataFrame ayant la même structure que df_complete, mais filtré pour l'affichage.
+        messages : Index par navire de df_complete (ais_messages.from_dataframe), à construire une fois par DataFrame chargé
+                   (session_memo) : sans lui, le tri est refait à chaque rerun.
     
     Returns :
         df_display : DataFrame filtré.
@@ -285,9 +1787,12 @@ def per_mmsi_filter(df_complete: pd.DataFrame, set_mmsi: set, df_display: pd.Dat
     
     points_selection: dict = {}
     mmsi_list = list(set_mmsi)
+    if messages is None:
+        messages = ais_messages.from_dataframe(df_complete)
     
     for i, mmsi in enumerate(mmsi_list):
-        nb_rows = len(df_complete[df_complete['mmsi'] == mmsi])
+        rows = messages.vessel(mmsi)
+        nb_rows = rows.stop - rows.start
         col = ga if i % 2 == 0 else dr
         nb_points = col.slider(
             f"MMSI {mmsi}",
@@ -301,7 +1806,8 @@ def per_mmsi_filter(df_complete: pd.DataFrame, set_mmsi: set, df_display: pd.Dat
     df_display_list: list = []
 
     for mmsi, nb_points in points_selection.items():
-        df_mmsi = df_complete[df_complete['mmsi'] == mmsi]
+        # Seules les lignes du navire sont copiées
+        df_mmsi = df_complete.iloc[messages.order[messages.vessel(mmsi)]]
         if len(df_mmsi) > nb_points:
             df_mmsi = df_mmsi.sample(nb_points, random_state=42)
         df_display_list.append(df_mmsi)
@@ -337,6 +1843,11 @@ def per_ship_type_filter(df_display : pd.DataFrame, df_ihs : pd.DataFrame) -> pd
     df_display['Ship type for pie chart'] = df_display['Ship type for pie chart'].fillna("Unknown")
     df_display['Ship type from IHS'] = df_display['Ship type from IHS'].fillna("Unknown")
     df_display=  df_display[df_display['Ship type for pie chart'].isin(type_choice)]
+    df_display = df_display.assign(**{
+        col: df_display[col].cat.remove_unused_categories()
+        for col in ['Ship type for pie chart', 'Ship type from IHS']
+        if isinstance(df_display[col].dtype, pd.CategoricalDtype)
+    })
 
     return df_display
 
@@ -361,8 +1872,8 @@ def map_settings(square : list[tuple], df_display : pd.DataFrame, list_mmsi_user
     dimensions : tuple =()
     
     if list_mmsi_user:
-        center = (df_display['lat'].mean(),df_display['long'].mean())
-        bounds = [(df_display['lat'].min(),df_display['long'].min()),(df_display['lat'].max(),df_display['long'].max())]
+        center = (float(df_display['lat'].mean()),float(df_display['long'].mean()))
+        bounds = [(float(df_display['lat'].min()),float(df_display['long'].min())),(float(df_display['lat'].max()),float(df_display['long'].max()))]
     else :
         bounds = square
         center = (np.mean([bounds[0][0], bounds[1][0]]), np.mean([bounds[0][1], bounds[1][1]]))
@@ -375,7 +1886,93 @@ def map_settings(square : list[tuple], df_display : pd.DataFrame, list_mmsi_user
     dimensions = (map_height,map_width)
 
 
-    return center, bounds, dimensions
+    return center, bounds, dimensions
+
+def map_tolerance_m(bounds : list[tuple], width_px : int = 1200) -> float:
+    """
+    Donne la distance au sol (m) couverte par un pixel de la carte à l'ouverture, d'après les limites de map_settings.
+    Sert de tolérance à la simplification des trajectoires (simplify_tracks).
+
+    Args :
+            bounds : limites de la carte [(lat_min, long_min), (lat_max, long_max)].
+            width_px : largeur de la carte en pixels.
+
+    Returns :
+            Mètres par pixel.
+    """
+    center_lat = (bounds[0][0] + bounds[1][0]) / 2
+    return haversine_dist_m(center_lat, bounds[0][1], center_lat, bounds[1][1]) / width_px
+
+def simplify_tracks(df : pd.DataFrame,
+                    max_points : int,
+                    tolerance_m : float = 0.0,
+                    stop_sog : float = 0.5,
+                    max_gap_s : float = traj_max_gap_s) -> pd.DataFrame:
+    """
+    Réduit le nombre de messages affichés en simplifiant la trajectoire de chaque navire, au lieu d'un échantillon aléatoire.
+
+    L'importance de chaque message est l'aire du triangle qu'il forme avec ses voisins (Visvalingam, en une passe
+    vectorisée sur les messages triés par navire et par date) : les virages sont gardés, les lignes droites allégées.
+    Sont toujours conservés les premier et dernier messages de chaque navire, ceux qui entourent une coupure
+    de plus de max_gap_s secondes et ceux qui marquent le début ou la fin d'un arrêt (sog < stop_sog).
+    Les messages dont l'aire est inférieure à celle d'un triangle de côté tolerance_m (invisible à l'échelle de la carte)
+    sont retirés, puis le budget max_points est réparti entre les navires au prorata de leurs messages restants,
+    chacun gardant ses messages les plus importants.
+
+    Args :
+            df : DataFrame des messages (colonnes mmsi, lat, long, sog, timestamp).
+            max_points : Nombre maximum de messages conservés (deux par navire au moins si le budget le permet).
+            tolerance_m : Longueur (m) en dessous de laquelle un détail de trajectoire est négligé, voir map_tolerance_m.
+            stop_sog : Vitesse (nd) en dessous de laquelle le navire est considéré à l'arrêt.
+            max_gap_s : Écart (s) entre deux messages au-delà duquel la trajectoire est coupée, None pour ne jamais couper.
+
+    Returns :
+            DataFrame des messages conservés, trié par navire puis par date.
+    """
+    messages = ais_messages.from_dataframe(df)
+    n = len(messages)
+    if n == 0:
+        return df
+
+    lat = np.radians(messages["lat"])
+    x = np.radians(messages["long"]) * np.cos(lat) * 6371000
+    y = lat * 6371000
+    area = np.full(n, np.inf)
+    if n > 2:
+        area[1:-1] = 0.5 * np.abs((x[:-2] - x[1:-1]) * (y[2:] - y[1:-1]) - (x[2:] - x[1:-1]) * (y[:-2] - y[1:-1]))
+
+    bound = np.zeros(n, dtype=bool)
+    bound[messages.offsets[:-1]] = True
+    bound[messages.offsets[1:] - 1] = True
+    breaks = np.diff(messages["sog"] < stop_sog)
+    if max_gap_s is not None:
+        breaks |= np.diff(messages["timestamp"]) > max_gap_s * 1e9
+    bound[1:] |= breaks
+    bound[:-1] |= breaks
+    area[bound] = np.inf
+
+    keep = area >= tolerance_m ** 2 / 2
+    vessel = np.repeat(np.arange(len(messages.vessels)), messages.counts())
+    eligible = np.bincount(vessel[keep], minlength=len(messages.vessels))
+    if eligible.sum() > max_points:
+        # Deux messages par navire si le budget le permet, le reste au prorata (plus forts restes), sans jamais dépasser max_points
+        base = np.minimum(eligible, 2)
+        if base.sum() > max_points:
+            base = np.zeros_like(eligible)
+        extra = eligible - base
+        share = (max_points - base.sum()) * extra / extra.sum()
+        budget = base + np.floor(share).astype(np.int64)
+        remaining = max_points - budget.sum()
+        budget[np.argsort(np.floor(share) - share, kind="stable")[:remaining]] += 1
+    else:
+        budget = eligible
+
+    ranked = np.lexsort((-area, ~keep, vessel))
+    rank = np.empty(n, dtype=np.int64)
+    rank[ranked] = np.arange(n) - messages.offsets[vessel[ranked]]
+    selected = keep & (rank < budget[vessel])
+
+    return df.iloc[messages.order[selected]]
 
 def create_rectangles(bounds : List[tuple]):
 
@@ -517,10 +2114,21 @@ class colormaps():
         row_name (str or None): Nom de la colonne utilisée pour la coloration (ex : 'sog' ou 'Draft').
         list (List[str] or None): Liste de types (depuis la BDD IHS) à associer à des couleurs distinctes.
 
+    Les couleurs sont précalculées une fois : table de cmap.N couleurs hexadécimales (256 pour 'jet')
+    pour les colormaps continues, et tableau code de catégorie -> couleur pour les types de navire
+    (la dernière entrée, "#888888", sert aux types absents de list). Ces tables sont partagées
+    par la coloration des points (colors) et par la légende (add_legend).
+
     Methods:
         ship_type_to_color() -> Dict[str, str]:
             Crée un dictionnaire associant chaque type dans list à une couleur.
 
+        values_to_colors(values) -> np.ndarray:
+            Couleurs hexadécimales d'un tableau de valeurs numériques (colormap continue).
+
+        colors(df) -> np.ndarray:
+            Couleur de chaque ligne de df, calculée en une seule passe vectorisée.
+
         color_per_row() -> Callable:
             Retourne une fonction qui prend une ligne (row) et renvoie une couleur selon le mode choisi :
             - Si list est fourni, la couleur dépend du type de navire (catégoriel).
@@ -529,7 +2137,8 @@ class colormaps():
 
         add_legend(m: folium.Map):
             Ajoute une légende à la carte folium m, selon le type de coloration utilisé :
-            - Légende linéaire si row_name est 'sog' ou 'Draft'.
+            - Légende linéaire si row_name est 'sog', 'Draft' ou 'count' (nombre de messages du mode densité),
+              logarithmique si row_name est 'density' (tuiles de densité de tile_server.py).
             - Légende catégorielle si list est renseignée.
     """
     def __init__(self, norm=None, cmap=None, row_name: str = None, list_type: List[str] = None):
@@ -550,6 +2159,16 @@ class colormaps():
         self.list = list_type
         self.row_name = row_name
 
+        self.lut = None
+        self.lut_rgba = None
+        self.type_palette = None
+        if self.list is not None:
+            rgba = self.cmap(np.arange(len(self.list))) if len(self.list) else np.empty((0, 4))
+            self.type_palette = np.array([matplotlib.colors.rgb2hex(c) for c in rgba] + ["#888888"], dtype=object)
+        elif self.cmap is not None:
+            self.lut_rgba = (self.cmap(np.arange(self.cmap.N)) * 255).round().astype(np.uint8)
+            self.lut = np.array([matplotlib.colors.rgb2hex(c) for c in self.cmap(np.arange(self.cmap.N))], dtype=object)
+
 
     def ship_type_to_color(self) -> dict[str, str]:
         """
@@ -560,7 +2179,51 @@ class colormaps():
             dict[str, str]: Dictionnaire où les clés sont les types de navires (str) et
             les valeurs sont les codes couleurs hexadécimaux (str).
         """
-        return {stype: matplotlib.colors.rgb2hex(self.cmap(i)) for i, stype in enumerate(self.list)}
+        return dict(zip(self.list, self.type_palette[:-1]))
+
+    def values_to_colors(self, values) -> np.ndarray:
+        """
+        Associe à chaque valeur la couleur de la table self.lut : la valeur normalisée (norm) est découpée
+        en cmap.N intervalles, comme le fait matplotlib. Les valeurs manquantes sont traitées comme 0.
+
+        Args:
+            values: Valeurs numériques (tableau, Series ou liste).
+
+        Returns:
+            np.ndarray: Couleurs hexadécimales (str).
+        """
+        return self.lut[self.values_to_indices(values)]
+
+    def values_to_indices(self, values) -> np.ndarray:
+        """
+        Indices dans les tables self.lut / self.lut_rgba des valeurs données (voir values_to_colors).
+        Conserve la forme de values (utilisé pour colorer une image, voir density_image).
+        """
+        shape = np.shape(values)
+        values = pd.to_numeric(pd.Series(np.ravel(values)), errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+        normed = np.ma.filled(self.norm(np.nan_to_num(values, nan=0.0)), np.nan).astype(np.float64)
+        idx = np.clip(np.nan_to_num(normed * len(self.lut), nan=0.0), 0, len(self.lut) - 1).astype(np.int64)
+        return idx.reshape(shape)
+
+    def colors(self, df: pd.DataFrame) -> np.ndarray:
+        """
+        Calcule la couleur de chaque ligne de df en une seule passe :
+        - colormap continue : valeurs de la colonne self.row_name via values_to_colors ;
+        - types de navire : code de 'Ship type from IHS' dans self.list, "#888888" si le type n'y est pas.
+
+        Args:
+            df: DataFrame des messages.
+
+        Returns:
+            np.ndarray: Couleurs hexadécimales (str), une par ligne, ou None si aucune coloration possible.
+        """
+        if self.type_palette is not None:
+            codes = pd.Categorical(df['Ship type from IHS'], categories=pd.unique(np.asarray(self.list, dtype=object))).codes
+            return self.type_palette[codes]
+        elif self.lut is not None:
+            return self.values_to_colors(df[self.row_name])
+        else:
+            return None
 
     def color_per_row(self):
         """
@@ -578,9 +2241,7 @@ class colormaps():
             une couleur hexadécimale, ou None si aucune coloration possible.
         """
         if self.list is None and self.cmap is not None:
-            return lambda row: matplotlib.colors.rgb2hex(
-                self.cmap(self.norm(0 if pd.isna(row[self.row_name]) else row[self.row_name]))
-            )
+            return lambda row: self.values_to_colors([row[self.row_name]])[0]
         elif self.list is not None:
             color_map = self.ship_type_to_color()
             return lambda row: color_map.get(row['Ship type from IHS'], "#888888")
@@ -597,15 +2258,25 @@ class colormaps():
         
 
         if self.row_name == "sog":
-            colors = [matplotlib.colors.rgb2hex(self.cmap(self.norm(v))) for v in np.linspace(0,25,50)]
+            colors = self.values_to_colors(np.linspace(0,25,50))
             legend_html = make_gradient_legend("Vitesse (nd)", vmin=0, vmax=25, colors=colors)
             m.get_root().html.add_child(folium.Element(legend_html))
 
         elif self.row_name == "Draft":
-            colors = [matplotlib.colors.rgb2hex(self.cmap(self.norm(v))) for v in np.linspace(0,25,50)]
+            colors = self.values_to_colors(np.linspace(0,25,50))
             legend_html = make_gradient_legend("Tirant d'eau (m)", vmin=0, vmax=25, colors=colors)
             m.get_root().html.add_child(folium.Element(legend_html))
 
+        elif self.row_name == "count":
+            colors = self.values_to_colors(np.geomspace(self.norm.vmin, self.norm.vmax, 50))
+            legend_html = make_gradient_legend("Nombre de messages", vmin=int(self.norm.vmin), vmax=int(round(self.norm.vmax)), colors=colors)
+            m.get_root().html.add_child(folium.Element(legend_html))
+
+        elif self.row_name == "density":
+            colors = self.values_to_colors(np.geomspace(self.norm.vmin, self.norm.vmax, 50))
+            legend_html = make_gradient_legend("Messages par km²", vmin=f"{self.norm.vmin:g}", vmax=f"{self.norm.vmax:g}", colors=colors)
+            m.get_root().html.add_child(folium.Element(legend_html))
+
         elif self.list is not None:
             color_map = self.ship_type_to_color()
             legend_html = '<b style="color:black;">Type de navire :</b><br>'
@@ -630,6 +2301,7 @@ class colormaps():
             m.get_root().html.add_child(folium.Element(full_html))
 
 
+@cancellable
 def get_dest_mmsi(date_start: str, date_end: str, list_mmsi_user: List[int]) -> pd.DataFrame:
     """
     Récupère, pour chaque MMSI spécifié, les 10 dernières destinations enregistrées dans la base
@@ -660,12 +2332,11 @@ def get_dest_mmsi(date_start: str, date_end: str, list_mmsi_user: List[int]) ->
     ) sub
     WHERE rn <= 10
     """
-    conn_loc = connect_pgsql()
-    cur_loc = conn_loc.cursor()
-    cur_loc.execute(sql_get)
-    rows = cur_loc.fetchall()
-    cur_loc.close()
-    conn_loc.close()
+    with get_pool("pgsql").connection() as conn_loc:
+        cur_loc = conn_loc.cursor()
+        cur_loc.execute(sql_get)
+        rows = cur_loc.fetchall()
+        cur_loc.close()
 
     df_destinations = pd.DataFrame(rows, columns=["mmsi", "Destinations uniques (dans l'ordre récent)"])
     df_destinations["Destinations uniques (dans l'ordre récent)"] = df_destinations["Destinations uniques (dans l'ordre récent)"].apply(lambda x: x if isinstance(x, str) else "Aucune destination")
@@ -673,10 +2344,126 @@ def get_dest_mmsi(date_start: str, date_end: str, list_mmsi_user: List[int]) ->
 
     return df_destinations
 
+class ihs_store():
+    """
+    Cache en mémoire des données statiques IHS (type, dimensions), indexé par MMSI et partagé par toutes les sessions.
+
+    Seuls les MMSI absents du cache ou dont l'entrée a expiré (plus de ttl_s secondes) sont demandés à la base.
+    Les MMSI inconnus de la base IHS sont aussi mémorisés, pour ne pas être redemandés à chaque rerun.
+    Length, Width et Size parameter sont calculés une seule fois, au chargement.
+
+    Attributes:
+        ttl_s (float): Durée de validité d'une entrée, en secondes.
+        batch_size (int): Nombre maximum de MMSI par requête.
+
+    Methods:
+        get(mmsis) -> pd.DataFrame:
+            Renvoie les données IHS des MMSI demandés, en chargeant les manquants.
+
+        clear():
+            Vide le cache.
+    """
+    def __init__(self, ttl_s: float = ihs_ttl_s, batch_size: int = ihs_batch_size):
+        """
+        Initialise un cache vide.
+
+        Args:
+            ttl_s (float): Durée de validité d'une entrée, en secondes.
+            batch_size (int): Nombre maximum de MMSI par requête.
+        """
+        self.ttl_s = ttl_s
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._table = pd.DataFrame(columns=ihs_columns[1:] + ['Length', 'Width', 'Size parameter'],
+                                   index=pd.Index([], dtype=np.int64, name='mmsi'))
+        self._fetched_at = pd.Series(dtype=np.float64, index=pd.Index([], dtype=np.int64, name='mmsi'))
+
+    def _fetch(self, mmsis: np.ndarray) -> pd.DataFrame:
+        rows: list = []
+        with get_pool("pgsql").connection() as conn_loc:
+            cur_loc = conn_loc.cursor()
+            for i in range(0, len(mmsis), self.batch_size):
+                cur_loc.execute(
+                    """
+                    SELECT mmsi, ship_type, ship_type_id, a, b, c, d, draft
+                    FROM static_data_ihs_id
+                    WHERE mmsi = ANY(%s);
+                    """,
+                    (mmsis[i:i + self.batch_size].tolist(),)
+                )
+                rows.extend(cur_loc.fetchall())
+            cur_loc.close()
+
+        rows_df = pd.DataFrame(rows, columns=ihs_columns)
+        rows_df['mmsi'] = rows_df['mmsi'].astype(np.int64)
+        for col in ['Ship type ID', 'a', 'b', 'c', 'd', 'Draft']:
+            values = pd.to_numeric(rows_df[col], errors='coerce')
+            # Les valeurs non entières de la base sont arrondies avant la conversion en entier nullable
+            rows_df[col] = (values.round() if ihs_dtypes[col] == "Int32" else values).astype(ihs_dtypes[col])
+        rows_df['Length'] = (rows_df['a'] + rows_df['b']).astype(ihs_dtypes['Length'])
+        rows_df['Width'] = (rows_df['c'] + rows_df['d']).astype(ihs_dtypes['Width'])
+        rows_df['Size parameter'] = (rows_df['Length'] * rows_df['Width']).astype(ihs_dtypes['Size parameter'])
+        rows_df['Ship type from IHS'] = rows_df['Ship type from IHS'].fillna('Unknown')
+        return rows_df.drop_duplicates('mmsi').set_index('mmsi')
+
+    def get(self, mmsis) -> pd.DataFrame:
+        """
+        Renvoie les données IHS des MMSI demandés. Les MMSI absents du cache ou expirés sont chargés depuis la base.
+
+        Args:
+            mmsis: MMSI recherchés (itérable d'entiers ou de chaînes).
+
+        Returns:
+            pd.DataFrame: Une ligne par MMSI connu de la base IHS, avec les colonnes de ihs_columns,
+            Length, Width et Size parameter.
+        """
+        mmsis = pd.unique(np.asarray(mmsis).astype(np.int64))
+        now = time.time()
+
+        with self._lock:
+            fetched_at = self._fetched_at.reindex(mmsis).to_numpy()
+        to_fetch = mmsis[~(now - fetched_at < self.ttl_s)]
+
+        if len(to_fetch):
+            fetched = self._fetch(to_fetch)
+            with self._lock:
+                kept = self._table.drop(index=to_fetch, errors='ignore')
+                self._table = fetched if kept.empty else pd.concat([kept, fetched])
+                self._fetched_at = pd.concat([
+                    self._fetched_at.drop(index=to_fetch, errors='ignore'),
+                    pd.Series(now, index=pd.Index(to_fetch, name='mmsi'))
+                ])
+
+        with self._lock:
+            table = self._table
+        return table.loc[table.index.intersection(mmsis)].reset_index()
+
+    def clear(self) -> None:
+        """
+        Vide le cache.
+        """
+        with self._lock:
+            self._table = self._table.iloc[0:0]
+            self._fetched_at = self._fetched_at.iloc[0:0]
+
+
+@st.cache_resource
+def get_ihs_store() -> ihs_store:
+    """
+    Renvoie le cache IHS du processus, créé au premier appel et partagé entre toutes les sessions (st.cache_resource).
+
+    Returns:
+        ihs_store : Cache des données statiques IHS.
+    """
+    return ihs_store()
+
+
+@cancellable
 def get_ihs(df: pd.DataFrame) -> pd.DataFrame:
     """
     Récupère les informations de dimensions et de type de navire depuis la base IHS,
     à partir d'un DataFrame contenant des MMSI.
+    Les données passent par le cache partagé (get_ihs_store) : seuls les MMSI encore inconnus sont demandés à la base.
 
     Args:
         df: DataFrame contenant une colonne 'mmsi'.
@@ -689,44 +2476,374 @@ def get_ihs(df: pd.DataFrame) -> pd.DataFrame:
         - a, b, c, d, Draft (dimensions brutes)
         - Length, Width, Size parameter
         - Ship type for pie chart
+        Les types de navire sont catégoriels (avec les catégories "Unknown" et "Other"),
+        les dimensions en float32, NaN si inconnues (voir ihs_dtypes).
     """
-    mmsi_list = ','.join(map(str, df['mmsi'].unique()))
-
-    sql_get = f"""
-    SELECT mmsi, ship_type, ship_type_id, a, b, c, d, draft
-    FROM static_data_ihs_id
-    WHERE mmsi IN ({mmsi_list});
-    """
-    conn_loc = connect_pgsql()
-    cur_loc = conn_loc.cursor()
-    cur_loc.execute(sql_get)
-    rows = cur_loc.fetchall()
-    rows_df = pd.DataFrame(rows, columns=['mmsi', 'Ship type from IHS', 'Ship type ID', 'a', 'b', 'c', 'd', 'Draft'])
-
-    rows_df['Length'] = rows_df['a'] + rows_df['b']
-    rows_df['Width'] = rows_df['c'] + rows_df['d']
-    rows_df['Size parameter'] = rows_df['Length'] * rows_df['Width']
-    rows_df['Ship type from IHS'] = rows_df['Ship type from IHS'].fillna('Unknown')
+    rows_df = get_ihs_store().get(df['mmsi'].unique())
 
     type_counts = rows_df['Ship type from IHS'].value_counts(normalize=True)
     rare_types = type_counts[type_counts < 0.02].index
-    rows_df['Ship type for pie chart'] = rows_df['Ship type from IHS'].apply(
-        lambda x: 'Other' if x in rare_types else x
+    rows_df['Ship type for pie chart'] = rows_df['Ship type from IHS'].where(
+        ~rows_df['Ship type from IHS'].isin(rare_types), 'Other'
     )
-    rows_df.replace(0, pd.NA, inplace=True)
-
-    cur_loc.close()
-    conn_loc.close()
+    for col in ['Ship type from IHS', 'Ship type for pie chart']:
+        rows_df[col] = rows_df[col].astype('category').cat.add_categories(
+            [t for t in ('Unknown', 'Other') if t not in rows_df[col].unique()]
+        )
+    dims = list(ihs_dtypes)
+    rows_df[dims] = rows_df[dims].mask(rows_df[dims] == 0)
 
     return rows_df
 
+@st.cache_resource
+def get_fetch_slots(secret_name: str) -> threading.BoundedSemaphore:
+    """
+    Renvoie le sémaphore des connexions du pool secret_name réservées aux threads supplémentaires de fetch_executor,
+    créé une seule fois par processus et partagé entre toutes les sessions (voir fetch_parallel_slots).
+    """
+    return threading.BoundedSemaphore(fetch_parallel_slots)
+
+
+@contextmanager
+def fetch_executor(max_workers: int = fetch_workers, secret_name: str = "local") -> Iterator[ThreadPoolExecutor]:
+    """
+    Crée un pool de threads dont les threads sont rattachés à la session Streamlit courante,
+    pour que les appels st.* (messages d'erreur) faits depuis les requêtes parallèles restent affichés,
+    et au query_scope courant, pour que leurs requêtes soient annulées avec celles du script.
+    Au-delà du premier, chaque thread prend une place de get_fetch_slots(secret_name) sans attendre : quand les places
+    sont prises par d'autres sessions, les tâches sont exécutées par moins de threads au lieu d'épuiser le pool.
+
+    Args:
+        max_workers : Nombre maximum de threads.
+        secret_name : Pool de connexions utilisé par les tâches ('local', 'pgsql' ou 'vm').
+
+    Yields:
+        ThreadPoolExecutor, fermé (et ses places rendues) à la sortie du bloc with.
+    """
+    ctx = get_script_run_ctx()
+    scope = current_query_scope()
+
+    def initializer():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        _thread_scope.scope = scope
+
+    slots = get_fetch_slots(secret_name)
+    extra = 0
+    while extra < max_workers - 1 and slots.acquire(blocking=False):
+        extra += 1
+    try:
+        with ThreadPoolExecutor(max_workers=1 + extra, initializer=initializer) as executor:
+            yield executor
+    finally:
+        for _ in range(extra):
+            slots.release()
+
+
+@cancellable
+@st.cache_data
+def get_traj_bundle(date_start : datetime,
+                    date_end : datetime,
+                    date_start_2 : datetime = None,
+                    date_end_2 : datetime = None,
+                    min_lat : float = None,
+                    max_lat : float = None,
+                    min_long : float = None,
+                    max_long : float = None,
+                    list_mmsi_user : List[str] = None) -> Tuple[ais_messages, pd.DataFrame]:
+    """
+    Récupère en parallèle les trois jeux de données du mode trajectoire :
+    les points (serveur local), les données IHS et les destinations (VM).
+
+    Les points sont lus par lots (curseur côté serveur). Dès qu'un lot contient des MMSI encore inconnus,
+    leurs données IHS (chargées dans le cache partagé get_ihs_store) et leurs destinations sont demandées
+    sur d'autres connexions pendant que les lots suivants arrivent. Si une liste de MMSI est fournie,
+    ces requêtes sont lancées immédiatement. Le temps total est ainsi proche de la plus longue des requêtes
+    au lieu de leur somme, et create_all_df trouve ensuite les données IHS déjà en cache.
+
+    Args :
+            date_start : Date de début du filtre sii list_mmsi_user is not None. Dans l'autre cas, c'est la plage temporelle pour sélectionner les points passant par une zone. au format YYYY-MM-DD
+            date_end : Date de findu filtre sii list_mmsi_user is not None. Dans l'autre cas, c'est la plage temporelle pour sélectionner les points passant par une zone. au format YYYY-MM-DD
+            date_start_2 : Date de début du second filtre. Permet de choisir l'intervalle temporelle, 
+            pour observer les points qui étaient dans la zone sélectionner pendant la période [date_start;date_end]. au format YYYY-MM-DD
+            date_end_2 : Date de fin du second filtre. Permet de choisir l'intervalle temporelle, 
+            pour observer les points qui étaient dans la zone sélectionner pendant la période [date_start;date_end]. au format YYYY-MM-DD
+            min_lat : Latitude minimum de la zone de passage. (limite sud)
+            max_lat : Latitude maximum de la zone de passage. (limite nord)
+            min_long : Longitude minimum de la zone de passage. (limite ouest)
+            max_long : Longitude maximum de la zone de passage. (limite est)
+            list_mmsi_user : Liste des MMSI des navires d'intérêt.
+
+    Returns :
+            points : Points de trajectoire, triés par navire puis par date (ais_messages).
+            df_dest : DataFrame des destinations (voir get_dest_mmsi).
+    """
+    sql = traj_sql(date_start, date_end, date_start_2, date_end_2, min_lat, max_lat, min_long, max_long, list_mmsi_user)
+    pool_loc = get_pool("local")
+    store = get_ihs_store()
+    seen_mmsi: set = set()
+    ihs_futures: list = []
+    dest_futures: list = []
+
+    # Données IHS et destinations : pool pgsql
+    with fetch_executor(secret_name="pgsql") as executor:
+        def submit_static(mmsis: list) -> None:
+            ihs_futures.append(executor.submit(store.get, mmsis))
+            dest_futures.append(executor.submit(get_dest_mmsi, date_start, date_end, mmsis))
+
+        user_mmsi = _parse_mmsi_list(list_mmsi_user)
+        if user_mmsi:
+            seen_mmsi.update(user_mmsi)
+            submit_static(sorted(user_mmsi))
+
+        builder = _columns_builder()
+        try:
+            with pool_loc.connection() as conn_loc:
+                for columns in iter_points_batches(conn_loc, sql):
+                    builder.append(columns)
+                    new_mmsi = set(np.unique(columns["mmsi"]).tolist()) - seen_mmsi
+                    if new_mmsi:
+                        seen_mmsi.update(new_mmsi)
+                        submit_static(sorted(new_mmsi))
+        except psycopg2.extensions.QueryCanceledError:
+            scope = current_query_scope()
+            if scope is not None and scope.cancelled:
+                raise
+            raise query_too_large(estimate_rows("local", sql))
+
+        for future in ihs_futures:
+            future.result()
+        dest_frames = [future.result() for future in dest_futures]
+
+    points = builder.to_messages()
+    present = set(points.vessels.tolist())
+    dest_frames = [r for r in dest_frames if isinstance(r, pd.DataFrame) and not r.empty]
+    if dest_frames:
+        df_dest = pd.concat(dest_frames, ignore_index=True)
+        df_dest = df_dest[df_dest["mmsi"].isin(present)].reset_index(drop=True)
+    else:
+        df_dest = pd.DataFrame(columns=["mmsi", "Destinations uniques (dans l'ordre récent)"])
+
+    return points, df_dest
+
+
+def trajectories_geojson(messages: ais_messages, max_gap_s: float = None) -> dict:
+    """
+    Construit les trajectoires de tous les navires en une FeatureCollection GeoJSON (une entité par navire).
+    Les messages étant déjà triés par (mmsi, timestamp), les tronçons sont délimités par les offsets des navires
+    et, si max_gap_s est fourni, par les écarts de plus de max_gap_s secondes entre deux messages consécutifs.
+    Un navire avec plusieurs tronçons est une MultiLineString ; les tronçons d'un seul message sont ignorés.
+
+    Args:
+        messages: messages triés par navire puis par date.
+        max_gap_s: écart maximal (s) entre deux messages d'un même tronçon, None pour ne jamais couper.
+
+    Returns:
+        dict: FeatureCollection, avec pour propriétés le MMSI, le nombre de messages et les dates de début et de fin.
+    """
+    n = len(messages)
+    breaks = np.zeros(n, dtype=bool)
+    breaks[messages.offsets[:-1]] = True
+    if max_gap_s is not None and n > 1:
+        breaks[1:] |= np.diff(messages["timestamp"]) > max_gap_s * 1e9
+
+    starts = np.flatnonzero(breaks)
+    ends = np.append(starts[1:], n)
+    kept = ends - starts > 1
+    starts, ends = starts[kept], ends[kept]
+    vessel_of = np.searchsorted(messages.offsets, starts, side="right") - 1
+
+    coords = np.column_stack((messages["long"], messages["lat"])).round(6).tolist()
+    lines: dict = {}
+    for v, start, end in zip(vessel_of.tolist(), starts.tolist(), ends.tolist()):
+        lines.setdefault(v, []).append(coords[start:end])
+
+    first = pd.to_datetime(messages["timestamp"][messages.offsets[:-1]], utc=True).strftime("%Y-%m-%d %H:%M")
+    last = pd.to_datetime(messages["timestamp"][messages.offsets[1:] - 1], utc=True).strftime("%Y-%m-%d %H:%M")
+    counts = messages.counts()
+
+    features: list = []
+    for v, parts in lines.items():
+        geometry = ({"type": "LineString", "coordinates": parts[0]} if len(parts) == 1
+                    else {"type": "MultiLineString", "coordinates": parts})
+        features.append({
+            "type": "Feature",
+            "geometry": geometry,
+            "properties": {"mmsi": int(messages.vessels[v]), "messages": int(counts[v]), "start": first[v], "end": last[v]},
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+def add_trajectories(m: folium.Map, messages: ais_messages, max_gap_s: float = traj_max_gap_s) -> None:
+    """
+    Trace la trajectoire de chaque navire (au moins deux messages) sur une carte Folium, en une seule couche GeoJSON.
+
+    Args:
+        m: objet folium.Map sur lequel ajouter les trajectoires.
+        messages: messages triés par navire puis par date.
+        max_gap_s: écart (s) au-delà duquel une trajectoire est coupée, None pour ne jamais couper.
+
+    Returns:
+        None
+    """
+    collection = trajectories_geojson(messages, max_gap_s)
+    if not collection["features"]:
+        return
+    folium.GeoJson(
+        collection,
+        on_each_feature=geojson_style(0.4, weight=2, color='black'),
+        tooltip=folium.GeoJsonTooltip(
+            fields=['mmsi', 'messages', 'start', 'end'],
+            aliases=['MMSI', 'Messages', 'Début', 'Fin'],
+        ),
+    ).add_to(m)
+
+# Propriétés des entités GeoJSON affichées dans les tooltips et popups (colonne, propriété, libellé, décimales)
+tooltip_fields=[('mmsi', 'mmsi', 'MMSI', None), ('Length', 'L', 'Longueur (m)', 0), ('Width', 'W', 'Largeur (m)', 0),
+                ('Draft', 'D', "Tirant d'eau (m)", 1), ('sog', 'sog', 'Vitesse (nd)', 1), ('timestamp', 't', 'Timestamp', None)]
+
+def _points_properties(df: pd.DataFrame, fields: list = tooltip_fields) -> pd.DataFrame:
+    """
+    Propriétés compactes de chaque message pour les tooltips et popups, générés côté navigateur à partir de ces champs :
+    nombres arrondis au nombre de décimales demandé, timestamp à la seconde, valeurs manquantes laissées vides.
+    """
+    properties = {}
+    for column, name, _, decimals in fields:
+        values = df[column]
+        if column == 'timestamp':
+            formatted = pd.to_datetime(values).dt.strftime("%Y-%m-%d %H:%M:%S")
+        elif column == 'mmsi':
+            formatted = values.astype(np.int64)
+        elif decimals is None:
+            formatted = values.astype(object).where(values.notna(), "")
+        else:
+            numbers = pd.to_numeric(values, errors="coerce").astype(np.float64).round(decimals)
+            if decimals == 0:
+                numbers = numbers.astype("Int64")
+            formatted = numbers.astype(object).where(numbers.notna(), "")
+        properties[name] = formatted.to_numpy()
+    return pd.DataFrame(properties)
+
+def geojson_style(opacity: float, fill_opacity: float = None, weight: float = 1, color: str = None) -> JsCode:
+    """
+    Style commun d'une couche GeoJSON, appliqué côté navigateur à chaque entité (on_each_feature) :
+    la couleur est lue dans la propriété color de l'entité, sauf si color est fourni.
+    Contrairement à style_function, aucun style par entité n'est sérialisé dans la page.
+    """
+    color_js = json.dumps(color) if color is not None else "feature.properties.color"
+    fill_js = "" if fill_opacity is None else f", fillColor: {color_js}, fillOpacity: {fill_opacity}"
+    return JsCode(f"""
+        function(feature, layer) {{
+            layer.setStyle({{color: {color_js}, opacity: {opacity}, weight: {weight}{fill_js}}});
+        }}
+    """)
+
+def features_geojson(geometries: np.ndarray, properties: pd.DataFrame) -> dict:
+    """
+    Construit une FeatureCollection GeoJSON à partir d'un tableau de géométries shapely et des propriétés associées.
+    Les points et les polygones sans trou sont écrits directement à partir de leurs coordonnées (arrondies au micro-degré),
+    les autres géométries via shapely.to_geojson.
+
+    Args:
+        geometries: tableau de géométries shapely (EPSG:4326), une par ligne de properties.
+        properties: DataFrame de propriétés sérialisables en JSON (chaînes, nombres).
+
+    Returns:
+        dict: FeatureCollection.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    type_ids = shapely.get_type_id(geometries)
+    if len(geometries) and (type_ids == 0).all():
+        geoms = [{"type": "Point", "coordinates": xy} for xy in shapely.get_coordinates(geometries).round(6).tolist()]
+    elif len(geometries) and (type_ids == 3).all() and (shapely.get_num_interior_rings(geometries) == 0).all():
+        coords = shapely.get_coordinates(geometries).round(6).tolist()
+        ends = np.cumsum(shapely.get_num_coordinates(geometries)).tolist()
+        geoms = [{"type": "Polygon", "coordinates": [coords[start:end]]} for start, end in zip([0] + ends[:-1], ends)]
+    else:
+        geoms = [json.loads(g) for g in shapely.to_geojson(geometries)]
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {"type": "Feature", "geometry": g, "properties": p}
+            for g, p in zip(geoms, properties.to_dict("records"))
+        ],
+    }
+
+def add_geojson_layer(
+    m: folium.Map,
+    geometries: np.ndarray,
+    df: pd.DataFrame,
+    opacity_choice: int = 80,
+    marker: folium.CircleMarker = None,
+    stroke: bool = True,
+    fields: list = tooltip_fields
+) -> None:
+    """
+    Ajoute toutes les géométries à la carte dans une seule couche GeoJSON, au lieu d'un objet Folium par navire.
+    La couleur de chaque entité est une propriété lue par un style commun appliqué côté navigateur (geojson_style),
+    et les tooltips et popups sont générés à partir des propriétés compactes de tooltip_fields ;
+    avec une carte créée avec prefer_canvas=True, Leaflet dessine la couche sur un canvas plutôt qu'en éléments SVG.
+
+    Args:
+        m: objet folium.Map sur lequel ajouter la couche.
+        geometries: tableau de géométries shapely (EPSG:4326), une par ligne de df.
+        df: DataFrame des messages (colonnes color, mmsi, sog, Draft, Length, Width, timestamp).
+        opacity_choice: opacité entre 0 et 100.
+        marker: marqueur utilisé pour les géométries de type point (ex: folium.CircleMarker).
+        stroke: dessine ou non le contour des entités.
+        fields: propriétés des tooltips et popups, au format de tooltip_fields.
+
+    Returns:
+        None
+    """
+    properties = _points_properties(df, fields)
+    properties['color'] = df['color'].to_numpy()
+    keep = ~(shapely.is_missing(np.asarray(geometries, dtype=object)) | shapely.is_empty(np.asarray(geometries, dtype=object)))
+    if not keep.any():
+        return
+
+    aliases = [label for _, _, label, _ in fields]
+    fields = [name for _, name, _, _ in fields]
+    folium.GeoJson(
+        features_geojson(np.asarray(geometries, dtype=object)[keep], properties[keep]),
+        marker=marker,
+        on_each_feature=geojson_style(opacity_choice / 100 if stroke else 0, fill_opacity=opacity_choice / 100),
+        tooltip=folium.GeoJsonTooltip(fields=fields, aliases=aliases),
+        popup=folium.GeoJsonPopup(fields=fields, aliases=aliases),
+    ).add_to(m)
+
+def size_buffers(df: pd.DataFrame, default_radius_m: float = 5, quad_segs: int = 4) -> np.ndarray:
+    """
+    Crée pour chaque message un disque de diamètre égal à la longueur du navire (default_radius_m de rayon si inconnue).
+    Les positions sont projetées en une fois en EPSG:3857, les disques calculés par un buffer vectorisé
+    avec un rayon par ligne, puis tous les sommets reprojetés en EPSG:4326 en un seul appel.
+
+    Args:
+        df: DataFrame contenant les colonnes lat, long et Length.
+        default_radius_m: rayon (m) utilisé quand la longueur est inconnue ou nulle.
+        quad_segs: nombre de segments par quart de cercle (4 * quad_segs + 1 sommets par disque).
+
+    Returns:
+        np.ndarray: Polygones shapely (EPSG:4326), un par ligne de df.
+    """
+    length = pd.to_numeric(df['Length'], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    radius = np.where(length > 0, length / 2, default_radius_m)
+
+    x, y = get_transformer("EPSG:4326", "EPSG:3857").transform(
+        df['long'].to_numpy(dtype=np.float64), df['lat'].to_numpy(dtype=np.float64)
+    )
+    buffers = shapely.buffer(shapely.points(x, y), radius, quad_segs=quad_segs)
+
+    to_deg = get_transformer("EPSG:3857", "EPSG:4326")
+    return shapely.transform(buffers, lambda xy: np.column_stack(to_deg.transform(xy[:, 0], xy[:, 1])))
+
 def add_points_circle(
     m: folium.Map,
     df: pd.DataFrame,
     colormap: object = None,
     size_choice: str = None,
     opacity_choice: int = 80,
-    page_type: str = None
+    page_type: str = None,
+    legend: bool = True
 ) -> None:
     """
     Ajoute des cercles (ou polygones selon le choix de l'utilisateur) sur une carte Folium à partir d'un DataFrame.
@@ -734,77 +2851,37 @@ def add_points_circle(
     Args:
         m: objet folium.Map sur lequel ajouter les points.
         df: DataFrame contenant les colonnes lat, long, mmsi, timestamp, sog, Draft, Length, Width.
-        colormap: objet Colormap avec méthodes color_per_row() et add_legend(map).
+        colormap: objet colormaps avec méthodes colors(df) et add_legend(map).
         size_choice: si "Constante", dessine des cercles fixes ; sinon, dessine des buffers à taille variable.
         opacity_choice: opacité entre 0 et 100.
         page_type: active ou non le tracé des trajectoires selon la page.
+        legend: ajoute la légende de la colormap (False si elle est déjà sur la carte).
     
     Returns:
         None
     """
     if colormap:
-        df['color'] = df.apply(colormap.color_per_row(), axis=1)
-        colormap.add_legend(m)
+        df['color'] = colormap.colors(df)
+        if legend:
+            colormap.add_legend(m)
     else:
         df['color'] = 'blue'
     
     if page_type:
-            for mmsi, group in df.groupby('mmsi'):
-                group_sorted = group.sort_values('timestamp')
-                points = list(zip(group_sorted['lat'], group_sorted['long']))
-                if len(points) > 1:
-                    folium.PolyLine(
-                        locations=points,
-                        color='black',
-                        weight=2,
-                        opacity=0.4,
-                        tooltip=f"MMSI: {int(mmsi)}"
-                    ).add_to(m)
+            add_trajectories(m, ais_messages.from_dataframe(df))
 
     if size_choice == "Constante":
-        for _, row in df.iterrows():
-            folium.CircleMarker(
-                location=(row['lat'], row['long']),
-                radius=8,
-                color=row['color'],
-                fill=True,
-                fill_color=row['color'],
-                fill_opacity=opacity_choice / 100,
-                opacity=0,
-                tooltip=f"MMSI: {int(row['mmsi'])} | Longueur : {row['Length']} m | Largeur : {row['Width']} m | Tirant d'eau : {row['Draft']} m | Vitesse : {row['sog']} nd | Timestamp : {row['timestamp']}",
-                popup=f"MMSI: {int(row['mmsi'])} | Longueur : {row['Length']} m | Largeur : {row['Width']} m | Tirant d'eau : {row['Draft']} m | Vitesse : {row['sog']} nd | Timestamp : {row['timestamp']}"
-            ).add_to(m)
-
-    else:
-        gdf = gpd.GeoDataFrame(
+        add_geojson_layer(
+            m,
+            shapely.points(df['long'].to_numpy(dtype=np.float64), df['lat'].to_numpy(dtype=np.float64)),
             df,
-            geometry=[Point(lon, lat) for lat, lon in zip(df['lat'], df['long'])],
-            crs="EPSG:4326"
-        )
-        gdf_proj = gdf.to_crs(epsg=3857)
-        gdf_proj['geometry'] = gdf_proj.apply(
-            lambda row: row.geometry.buffer(float(row['Length']) / 2)
-            if pd.notna(row['Length']) and row['Length'] > 0
-            else row.geometry.buffer(5),
-            axis=1
+            opacity_choice,
+            marker=folium.CircleMarker(radius=8, fill=True),
+            stroke=False
         )
-        gdf_buffered = gdf_proj.to_crs(epsg=4326)
 
-        
-
-        for _, row in gdf_buffered.iterrows():
-            folium.GeoJson(
-                row['geometry'],
-                style_function=lambda feature, color=row['color']: {
-                    'color': color,
-                    'opacity': opacity_choice / 100,
-                    'fillColor': color,
-                    'fillOpacity': opacity_choice / 100,
-                    'weight': 1,
-                },
-                tooltip=f"MMSI: {int(row['mmsi'])} | Longueur : {row['Length']} m | Largeur : {row['Width']} m | Tirant d'eau : {row['Draft']} m | Vitesse : {row['sog']} nd | Timestamp : {row['timestamp']}",
-                popup=f"MMSI: {int(row['mmsi'])} | Longueur : {row['Length']} m | Largeur : {row['Width']} m | Tirant d'eau : {row['Draft']} m | Vitesse : {row['sog']} nd | Timestamp : {row['timestamp']}"
-            ).add_to(m)
+    else:
+        add_geojson_layer(m, size_buffers(df), df, opacity_choice)
 
 def add_points_poly(
     m: folium.Map,
@@ -819,7 +2896,7 @@ def add_points_poly(
     Args:
         m: objet folium.Map sur lequel ajouter les polygones.
         df: DataFrame avec une colonne`polygon contenant des objets shapely.geometry.Polygon (et tout le reste).
-        colormap: objet Colormap avec méthodes color_per_row() et add_legend(map).
+        colormap: objet colormaps avec méthodes colors(df) et add_legend(map).
         opacity_choice: opacité entre 0 et 100.
         page_type: active ou non le tracé des trajectoires selon la page.
     
@@ -829,43 +2906,31 @@ def add_points_poly(
     df = df.dropna(subset=['polygon']).copy()
 
     if colormap:
-        df['color'] = df.apply(colormap.color_per_row(), axis=1)
+        df['color'] = colormap.colors(df)
         colormap.add_legend(m)
-
-    gdf = gpd.GeoDataFrame(df, geometry=df["polygon"], crs="EPSG:4326")
+    else:
+        df['color'] = 'blue'
 
     if page_type:
-        for mmsi, group in df.groupby('mmsi'):
-            group_sorted = group.sort_values('timestamp')
-            points = list(zip(group_sorted['lat'], group_sorted['long']))
-            if len(points) > 1:
-                folium.PolyLine(
-                    locations=points,
-                    color='black',
-                    weight=2,
-                    opacity=0.4,
-                    tooltip=f"MMSI: {int(mmsi)}"
-                ).add_to(m)
-
-    for _, row in gdf.iterrows():
-        folium.GeoJson(
-            row['geometry'],
-            style_function=lambda feature, color=row['color'] if colormap else 'blue': {
-                'color': color,
-                'opacity': opacity_choice / 100,
-                'fillColor': color,
-                'fillOpacity': opacity_choice / 100,
-                'weight': 1,
-            },
-            tooltip=f"MMSI: {int(row['mmsi'])} | Longueur : {row['Length']} m | Largeur : {row['Width']} m | Tirant d'eau : {row['Draft']} m | Vitesse : {row['sog']} nd | Timestamp : {row['timestamp']}",
-            popup=f"MMSI: {int(row['mmsi'])} | Longueur : {row['Length']} m | Largeur : {row['Width']} m | Tirant d'eau : {row['Draft']} m | Vitesse : {row['sog']} nd | Timestamp : {row['timestamp']}"
-        ).add_to(m)
+        add_trajectories(m, ais_messages.from_dataframe(df))
+
+    add_geojson_layer(m, df['polygon'].to_numpy(), df, opacity_choice)
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(crs_from: str, crs_to: str) -> Transformer:
+    """
+    Renvoie un Transformer pyproj (axes dans l'ordre longitude, latitude), créé une seule fois par couple de systèmes.
+    """
+    return Transformer.from_crs(crs_from, crs_to, always_xy=True)
 
 def create_poly_with_arrow(
     df_input: pd.DataFrame
 ) -> List[Optional[Polygon]]:
     """
     Crée des polygones orientés en forme de bateau avec flèche (provenance des dimensions a, b, c, d + cap).
+    Tous les navires sont traités en une fois : coins calculés par broadcasting NumPy,
+    une seule transformation de coordonnées dans chaque sens et construction vectorisée des polygones (shapely 2).
 
     Args:
         df_input: DataFrame complet avec les colonnes dynamiques et statiques.
@@ -873,61 +2938,411 @@ def create_poly_with_arrow(
     Returns:
         polys: Une liste de polygones (ou None si données manquantes) représentant chaque navire avec orientation.
     """
-    transformer_to_m = Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
-    transformer_to_deg = Transformer.from_crs("EPSG:3857", "EPSG:4326", always_xy=True)
+    transformer_to_m = get_transformer("EPSG:4326", "EPSG:3857")
+    transformer_to_deg = get_transformer("EPSG:3857", "EPSG:4326")
 
     arrow_length_factor = 0.2
     boat_length_factor = 1.3
     boat_width_factor = 1
 
-    polys: List[Optional[Polygon]] = []
-
     required_cols = {"a", "b", "c", "d", "long", "lat"}
     missing = required_cols - set(df_input.columns)
     if missing:
         raise KeyError(f"df_input missing required columns: {sorted(missing)}")
 
-    for _, row in df_input.iterrows():
-        if (
-            pd.isna(row["a"]) or pd.isna(row["b"]) or pd.isna(row["c"]) or pd.isna(row["d"]) or
-            pd.isna(row["long"]) or pd.isna(row["lat"])
-        ):
-            polys.append(None)
-            continue
-
-        a = float(row["a"]) * 0.8 * boat_length_factor
-        b = float(row["b"]) * 0.8 * boat_length_factor  
-        c = float(row["c"]) * boat_width_factor   
-        d = float(row["d"]) * boat_width_factor  
-
-        lon = float(row["long"])
-        lat = float(row["lat"])
-        cog = float(row.get("cog", 0.0)) if pd.notna(row.get("cog", 0.0)) else 0.0
-        angle_deg = cog
-
-        x_center, y_center = transformer_to_m.transform(lon, lat)
-
-        full_poly_corners_ccw = np.array([
-            [-c, -b],
-            [ d, -b],
-            [ d,  a],
-            [(-c+d)/2, a + (a+b) * arrow_length_factor],
-            [-c,  a]
-        ])
-
-        angle_rad = math.radians(-angle_deg)
-        rotation = np.array([
-            [math.cos(angle_rad), -math.sin(angle_rad)],
-            [math.sin(angle_rad),  math.cos(angle_rad)]
-        ])
-        rotated = (full_poly_corners_ccw @ rotation.T)
-        translated = rotated + np.array([x_center, y_center])
-        lonlat_corners = [transformer_to_deg.transform(x, y) for x, y in translated]
-
-        polygon = Polygon(lonlat_corners)
-        polys.append(polygon)
+    def as_float(col: str) -> np.ndarray:
+        return pd.to_numeric(df_input[col], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+
+    a, b, c, d, lon, lat = (as_float(col) for col in ("a", "b", "c", "d", "long", "lat"))
+    cog = as_float("cog") if "cog" in df_input.columns else np.zeros(len(df_input))
+    cog = np.nan_to_num(cog, nan=0.0)
+
+    polys: List[Optional[Polygon]] = [None] * len(df_input)
+    valid = ~np.isnan(np.column_stack((a, b, c, d, lon, lat))).any(axis=1)
+    if not valid.any():
+        return polys
+
+    a = a[valid] * 0.8 * boat_length_factor
+    b = b[valid] * 0.8 * boat_length_factor
+    c = c[valid] * boat_width_factor
+    d = d[valid] * boat_width_factor
+
+    x_center, y_center = transformer_to_m.transform(lon[valid], lat[valid])
+
+    # Coins dans le repère du navire (n, 5) : arrière gauche, arrière droit, avant droit, pointe de la flèche, avant gauche
+    corners_x = np.column_stack((-c, d, d, (-c + d) / 2, -c))
+    corners_y = np.column_stack((-b, -b, a, a + (a + b) * arrow_length_factor, a))
+
+    angle_rad = np.radians(-cog[valid])[:, None]
+    cos_a, sin_a = np.cos(angle_rad), np.sin(angle_rad)
+    x = corners_x * cos_a - corners_y * sin_a + x_center[:, None]
+    y = corners_x * sin_a + corners_y * cos_a + y_center[:, None]
+
+    lon_corners, lat_corners = transformer_to_deg.transform(x.ravel(), y.ravel())
+    rings = np.stack((lon_corners, lat_corners), axis=-1).reshape(-1, 5, 2)
+
+    for i, polygon in zip(np.flatnonzero(valid), shapely.polygons(rings)):
+        polys[i] = polygon
 
     return polys
 
 
+def _web_mercator(long: np.ndarray, lat: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Projette des positions en Web Mercator (EPSG:3857, m), latitudes bornées à ±85.0511°.
+    """
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -85.0511, 85.0511)
+    x = np.radians(np.asarray(long, dtype=np.float64)) * 6378137.0
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * 6378137.0
+    return x, y
+
+def _padded_bounds(bounds: List[tuple], min_span_deg: float = 1e-3) -> List[tuple]:
+    """
+    Élargit autour de leur centre des limites de taille nulle (un seul message, ou un navire immobile),
+    pour que la grille de density_grid et l'image aient une surface.
+    """
+    (lat0, long0), (lat1, long1) = bounds
+    if lat1 - lat0 < min_span_deg:
+        lat0, lat1 = (lat0 + lat1 - min_span_deg) / 2, (lat0 + lat1 + min_span_deg) / 2
+    if long1 - long0 < min_span_deg:
+        long0, long1 = (long0 + long1 - min_span_deg) / 2, (long0 + long1 + min_span_deg) / 2
+    return [(lat0, long0), (lat1, long1)]
+
+def density_grid(
+    df: pd.DataFrame,
+    bounds: List[tuple],
+    stat: str = "count",
+    width_px: int = raster_width_px,
+    weight: float = 1.0
+) -> np.ndarray:
+    """
+    Agrège tous les messages sur une grille de pixels Web Mercator couvrant bounds, en une passe NumPy (bincount).
+
+    Args:
+        df: DataFrame des messages (colonnes lat, long, et sog ou Draft selon stat).
+        bounds: limites de la grille [(lat_min, long_min), (lat_max, long_max)].
+        stat: "count" (nombre de messages), "sog" (vitesse moyenne) ou "Draft" (tirant d'eau maximum).
+        width_px: largeur de la grille en pixels, la hauteur respecte les proportions en Web Mercator.
+        weight: poids de chaque message pour "count" (1 / taux d'échantillonnage si les messages sont un échantillon).
+
+    Returns:
+        np.ndarray: grille (hauteur, largeur), ligne 0 au nord, NaN pour les pixels sans message.
+    """
+    bounds = _padded_bounds(bounds)
+    x0, y0 = _web_mercator(bounds[0][1], bounds[0][0])
+    x1, y1 = _web_mercator(bounds[1][1], bounds[1][0])
+    height = int(np.clip(round(width_px * (y1 - y0) / (x1 - x0)), 1, raster_max_px))
+
+    x, y = _web_mercator(df['long'].to_numpy(dtype=np.float64), df['lat'].to_numpy(dtype=np.float64))
+    # Les messages situés exactement sur le bord est / sud tombent dans la dernière colonne / ligne
+    inside = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+    col = np.minimum(np.floor((x - x0) / (x1 - x0) * width_px), width_px - 1)
+    row = np.minimum(np.floor((y1 - y) / (y1 - y0) * height), height - 1)
+    cell = (row[inside] * width_px + col[inside]).astype(np.int64)
+    size = width_px * height
+
+    if stat == "count":
+        grid = np.bincount(cell, minlength=size) * float(weight)
+        grid[grid == 0] = np.nan
+    else:
+        values = pd.to_numeric(df[stat], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)[inside]
+        known = ~np.isnan(values)
+        if stat == "sog":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                grid = (np.bincount(cell[known], weights=values[known], minlength=size)
+                        / np.bincount(cell[known], minlength=size))
+        elif stat == "Draft":
+            grid = np.full(size, -np.inf)
+            np.maximum.at(grid, cell[known], values[known])
+            grid[np.isinf(grid)] = np.nan
+        else:
+            raise ValueError(f"Statistique inconnue : {stat}")
+
+    return grid.reshape(height, width_px)
+
+def density_image(grid: np.ndarray, colormap: colormaps, opacity_choice: int = 80) -> np.ndarray:
+    """
+    Colore une grille de density_grid avec la table RGBA de colormap (mêmes couleurs que les points et la légende).
+    Les pixels sans message sont transparents.
+
+    Returns:
+        np.ndarray: image RGBA (hauteur, largeur, 4) en uint8.
+    """
+    image = colormap.lut_rgba[colormap.values_to_indices(grid)]
+    image[..., 3] = np.where(np.isnan(grid), 0, round(255 * opacity_choice / 100))
+    return image
+
+def add_density_layer(
+    m: folium.Map,
+    df: pd.DataFrame,
+    bounds: List[tuple],
+    colormap: colormaps,
+    stat: str = "count",
+    opacity_choice: int = 80,
+    weight: float = 1.0
+) -> np.ndarray:
+    """
+    Ajoute à la carte une image de densité de tous les messages (voir density_grid) et la légende associée.
+    Le coût dans le navigateur ne dépend que de la taille de l'image, pas du nombre de messages.
+
+    Args:
+        m: objet folium.Map sur lequel ajouter l'image.
+        df: DataFrame des messages.
+        bounds: limites de l'image [(lat_min, long_min), (lat_max, long_max)].
+        colormap: objet colormaps (continu) utilisé pour colorer les pixels. Si sa norme n'a pas de bornes
+                  (ex: LogNorm() pour "count"), elles sont fixées d'après la grille.
+        stat: "count", "sog" ou "Draft".
+        opacity_choice: opacité entre 0 et 100.
+        weight: poids de chaque message pour "count".
+
+    Returns:
+        np.ndarray: grille calculée, ou None si aucun message n'est à afficher (ni image ni légende ajoutée).
+    """
+    if df.empty or not np.isfinite(np.asarray(bounds, dtype=np.float64)).all():
+        return None
+    bounds = _padded_bounds(bounds)
+    grid = density_grid(df, bounds, stat, weight=weight)
+    finite = np.isfinite(grid)
+    if not finite.any():
+        return None
+    if not colormap.norm.scaled():
+        colormap.norm.autoscale_None(grid[finite])
+
+    folium.raster_layers.ImageOverlay(
+        image=density_image(grid, colormap, opacity_choice),
+        bounds=[list(bounds[0]), list(bounds[1])],
+        interactive=False,
+    ).add_to(m)
+    colormap.add_legend(m)
+    return grid
+
+def tile_density_colormap() -> colormaps:
+    """
+    Colormap des tuiles de densité (messages par km², échelle logarithmique sur tile_density_range),
+    partagée par tile_server.py et par la légende des cartes.
+    """
+    return colormaps(matplotlib.colors.LogNorm(*tile_density_range), matplotlib.colormaps.get_cmap('jet'), 'density')
+
+def tile_url(layer: str, date_start: datetime, date_end: datetime) -> str:
+    """
+    Modèle d'URL {z}/{x}/{y} des tuiles d'une couche ("density" ou "tracks") de tile_server.py pour une période.
+    """
+    return f"{tile_server_url.rstrip('/')}/{layer}/{pd.Timestamp(date_start):%Y-%m-%d}/{pd.Timestamp(date_end):%Y-%m-%d}/{{z}}/{{x}}/{{y}}.png"
+
+def add_tile_layers(m: folium.Map, date_start: datetime, date_end: datetime, opacity_choice: int = 80, legend: bool = True) -> bool:
+    """
+    Ajoute à la carte les couches de tuiles de densité et de trajectoires servies par tile_server.py pour la période donnée.
+    Les tuiles sont chargées directement par le navigateur : se déplacer ou zoomer sur la carte
+    ne relance ni le script Streamlit ni de requête depuis l'application.
+
+    Args:
+        m: objet folium.Map sur lequel ajouter les couches.
+        date_start: début de la période.
+        date_end: fin de la période.
+        opacity_choice: opacité des couches entre 0 et 100.
+        legend: ajoute la légende de densité.
+
+    Returns:
+        bool: False si aucun serveur de tuiles n'est configuré (tile_server_url), True sinon.
+    """
+    if tile_server_url is None:
+        return False
+
+    folium.TileLayer(
+        tiles=tile_url("density", date_start, date_end),
+        attr="AIS",
+        name="Densité des messages (tuiles)",
+        overlay=True,
+        control=True,
+        opacity=opacity_choice / 100,
+    ).add_to(m)
+    folium.TileLayer(
+        tiles=tile_url("tracks", date_start, date_end),
+        attr="AIS",
+        name="Trajectoires (tuiles)",
+        overlay=True,
+        control=True,
+        show=False,
+        min_zoom=tile_tracks_min_zoom,
+        opacity=opacity_choice / 100,
+    ).add_to(m)
+    folium.LayerControl(collapsed=True).add_to(m)
+    if legend:
+        tile_density_colormap().add_legend(m)
+    return True
+
+# Propriétés des cellules du mode agrégation (voir tooltip_fields)
+cell_tooltip_fields=[('count', 'n', 'Messages', 0), ('mmsi', 'mmsi', 'MMSI distincts', None), ('sog', 'sog', 'Vitesse moyenne (nd)', 1),
+                     ('Draft', 'D', "Tirant d'eau moyen (m)", 1), ('Ship type from IHS', 'type', 'Type dominant', None)]
+
+def aggregation_cell_m(bounds: List[tuple], cells_across: int = aggregation_cells_across) -> float:
+    """
+    Taille (m, en Web Mercator) des cellules d'agrégation pour les limites de carte données par map_settings :
+    environ cells_across cellules sur la largeur, arrondie à une puissance de 2 pour que des zones d'étendue proche
+    partagent la même résolution (comme les niveaux de zoom de la carte).
+    """
+    x0, _ = _web_mercator(bounds[0][1], bounds[0][0])
+    x1, _ = _web_mercator(bounds[1][1], bounds[1][0])
+    return float(2.0 ** round(math.log2(max(float(x1 - x0), 1.0) / cells_across)))
+
+def _cell_index(x: np.ndarray, y: np.ndarray, cell_m: float, shape: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Indices (i, j) de la cellule contenant chaque position Web Mercator : colonne / ligne pour les carrés,
+    coordonnées axiales (q, r) arrondies en coordonnées cubiques pour les hexagones (pointe en haut, largeur cell_m).
+    """
+    if shape == "square":
+        return np.floor(x / cell_m).astype(np.int64), np.floor(y / cell_m).astype(np.int64)
+
+    size = cell_m / math.sqrt(3)
+    q = (math.sqrt(3) / 3 * x - y / 3) / size
+    r = (2 / 3 * y) / size
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(np.int64), rr.astype(np.int64)
+
+def cell_polygons(i: np.ndarray, j: np.ndarray, cell_m: float, shape: str) -> np.ndarray:
+    """
+    Polygones shapely (EPSG:4326) des cellules (i, j) de _cell_index, construits en un seul appel à shapely.polygons.
+    """
+    i, j = np.asarray(i, dtype=np.float64), np.asarray(j, dtype=np.float64)
+    if shape == "square":
+        corners = np.array([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)], dtype=np.float64) * cell_m
+        x = i[:, None] * cell_m + corners[:, 0]
+        y = j[:, None] * cell_m + corners[:, 1]
+    else:
+        size = cell_m / math.sqrt(3)
+        angles = np.radians(30 + 60 * np.arange(7))
+        cx = size * math.sqrt(3) * (i + j / 2)
+        cy = size * 1.5 * j
+        x = cx[:, None] + size * np.cos(angles)
+        y = cy[:, None] + size * np.sin(angles)
+
+    long = np.degrees(x / 6378137.0)
+    lat = np.degrees(2 * np.arctan(np.exp(y / 6378137.0)) - np.pi / 2)
+    return shapely.polygons(np.stack([long, lat], axis=-1))
+
+def frame_fingerprint(df: pd.DataFrame) -> int:
+    """
+    Empreinte du contenu des messages (hash vectorisé des lignes), à utiliser comme clé de cache à la place du DataFrame :
+    deux sélections ne partagent la même empreinte que si leurs messages sont identiques, quels que soient les filtres appliqués.
+
+    Args:
+        df: DataFrame des messages.
+
+    Returns:
+        int: Empreinte 64 bits.
+    """
+    columns = [c for c in ('mmsi', 'lat', 'long', 'timestamp', 'sog', 'Draft', 'Ship type from IHS') if c in df.columns]
+    return int(pd.util.hash_pandas_object(df[columns], index=False).to_numpy().sum())
+
+@st.cache_data(max_entries=20)
+def aggregate_cells(_df: pd.DataFrame, fingerprint: int, cell_m: float, shape: str = "hex", weight: float = 1.0) -> pd.DataFrame:
+    """
+    Regroupe les messages par cellule (hexagone ou carré de cell_m mètres en Web Mercator) en une passe vectorisée.
+    Le résultat est gardé en cache par (fingerprint, cell_m, shape, weight) : _df n'est pas haché par Streamlit,
+    fingerprint (frame_fingerprint) en décrit le contenu.
+
+    Args:
+        _df: DataFrame des messages (colonnes lat, long, mmsi, sog, Draft, Ship type from IHS).
+        fingerprint: empreinte de _df (frame_fingerprint).
+        cell_m: taille des cellules (voir aggregation_cell_m).
+        shape: "hex" ou "square".
+        weight: poids de chaque message dans le nombre de messages (1 / taux d'échantillonnage).
+
+    Returns:
+        pd.DataFrame: une ligne par cellule : i, j, count (messages), mmsi (MMSI distincts), sog (vitesse moyenne),
+        Draft (tirant d'eau moyen) et Ship type from IHS (type le plus fréquent).
+    """
+    x, y = _web_mercator(_df['long'].to_numpy(dtype=np.float64), _df['lat'].to_numpy(dtype=np.float64))
+    i, j = _cell_index(x, y, cell_m, shape)
+    data = pd.DataFrame({
+        'i': i,
+        'j': j,
+        'mmsi': _df['mmsi'].to_numpy(),
+        'sog': pd.to_numeric(_df['sog'], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan),
+        'Draft': pd.to_numeric(_df['Draft'], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan),
+        'Ship type from IHS': _df['Ship type from IHS'].astype(object).fillna("Unknown").to_numpy(),
+    })
+
+    cells = data.groupby(['i', 'j'], sort=False).agg(
+        count=('mmsi', 'size'), mmsi=('mmsi', 'nunique'), sog=('sog', 'mean'), Draft=('Draft', 'mean')
+    )
+    cells['count'] = cells['count'] * weight
+    dominant = (data.groupby(['i', 'j', 'Ship type from IHS'], sort=False).size().rename('n').reset_index()
+                .sort_values('n', ascending=False, kind="stable").drop_duplicates(['i', 'j']).set_index(['i', 'j']))
+    cells['Ship type from IHS'] = dominant['Ship type from IHS']
+    return cells.reset_index()
+
+def add_cells_layer(
+    m: folium.Map,
+    cells: pd.DataFrame,
+    cell_m: float,
+    shape: str = "hex",
+    colormap: colormaps = None,
+    opacity_choice: int = 80
+) -> None:
+    """
+    Ajoute à la carte les cellules de aggregate_cells dans une seule couche GeoJSON (add_geojson_layer), avec leur légende.
+    Sans colormap, les cellules sont colorées par nombre de messages (échelle logarithmique).
+
+    Args:
+        m: objet folium.Map sur lequel ajouter les cellules.
+        cells: DataFrame renvoyé par aggregate_cells.
+        cell_m: taille des cellules.
+        shape: "hex" ou "square".
+        colormap: objet colormaps appliqué aux colonnes des cellules ('sog', 'Draft' ou type dominant).
+        opacity_choice: opacité entre 0 et 100.
+
+    Returns:
+        None
+    """
+    if cells.empty:
+        return
+    if colormap is None:
+        colormap = colormaps(matplotlib.colors.LogNorm(), matplotlib.colormaps.get_cmap('jet'), 'count')
+        colormap.norm.autoscale_None(cells['count'].to_numpy(dtype=np.float64))
+        if colormap.norm.vmax <= colormap.norm.vmin:
+            colormap.norm.vmax = colormap.norm.vmin + 1
+
+    polygons = cell_polygons(cells['i'].to_numpy(), cells['j'].to_numpy(), cell_m, shape)
+    add_geojson_layer(m, polygons, cells.assign(color=colormap.colors(cells)), opacity_choice,
+                      stroke=False, fields=cell_tooltip_fields)
+    colormap.add_legend(m)
+
+class zoom_switch(MacroElement):
+    """
+    Affiche far_layer tant que le zoom reste à moins de zoom_levels niveaux du zoom d'ouverture de la carte,
+    et near_layer au-delà. La bascule est faite par le navigateur : zoomer ne relance pas le script.
+    À ajouter à la carte après fit_bounds, pour que le zoom d'ouverture soit connu.
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var far = {{ this.far_layer.get_name() }};
+            var near = {{ this.near_layer.get_name() }};
+            var threshold = map.getZoom() + {{ this.zoom_levels }};
+            function update() {
+                var show = map.getZoom() >= threshold ? near : far;
+                var hide = show === near ? far : near;
+                if (map.hasLayer(hide)) { map.removeLayer(hide); }
+                if (!map.hasLayer(show)) { map.addLayer(show); }
+            }
+            map.on('zoomend', update);
+            update();
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, far_layer: folium.FeatureGroup, near_layer: folium.FeatureGroup, zoom_levels: int = aggregation_points_zoom):
+        super().__init__()
+        self._name = "ZoomSwitch"
+        self.far_layer = far_layer
+        self.near_layer = near_layer
+        self.zoom_levels = int(zoom_levels)
 
@@ -72,50 +72,40 @@ date_range = gauche.slider("Sélection de la plage temporelle ",
     step=datetime.timedelta(days=1),
     format="YYYY-MM-DD"
 )
-
-
-rows = get_points(date_range[0], date_range[1],min_lat, max_lat, min_long, max_long,list_mmsi_user)
-
-if rows:
-    df_ihs, df_complete, set_mmsi = create_all_df(rows)
-    list_type_ihs = df_ihs['Ship type for pie chart'].fillna("Unknown").unique()
-
-    st.session_state['df_ihs']=df_ihs
-    st.session_state['df']=df_complete
-  
-    
-    max_points = gauche.slider(
-        "Nombre de points affichés ",
-        min_value=10,
-        max_value=10000,
-        value=min(1000, len(df_complete)),
-        step=500
-    )
-
-    if len(df_complete) > max_points:
-        df_display = df_complete.sample(max_points, random_state=42)
-    else:
-        df_display = df_complete
-
-    
-    if list_mmsi_user:
-        df_display = per_mmsi_filter(df_complete,set_mmsi,df_display)
-    with droite:
-        df_display=per_ship_type_filter(df_display,df_ihs)
- 
-    opacity_choice=gauche.slider(
+display_mode = gauche.radio(
+    "Mode d'affichage :",
+    options=["Points", "Agrégation", "Densité"],
+    index=0,
+    horizontal=True,
+    key="display_mode",
+    help="Le mode agrégation regroupe les messages par cellule, de taille adaptée à la zone affichée. "
+    "Le mode densité affiche tous les messages sous forme d'image, quel que soit leur nombre."
+)
+density_mode = display_mode == "Densité"
+aggregate_mode = display_mode == "Agrégation"
+# Les modes agrégation et densité utilisent tous les messages de la sélection, pas l'échantillon affiché
+all_messages = density_mode or aggregate_mode
+
+
+@st.fragment
+def render_map(df_display, bounds, center, plan, list_type_ihs, density_mode, aggregate_mode, fingerprint, max_points):
+    """
+    Options d'affichage et carte. Le fragment est seul relancé quand une option d'affichage change :
+    les données et les filtres ne sont pas recalculés.
+    """
+    all_messages = density_mode or aggregate_mode
+    gauche_style, droite_style = st.columns(2)
+
+    opacity_choice=gauche_style.slider(
             "Sélection de l'opacité des navires (%) ",
             min_value=0,
             max_value=100,
             value=80,
-            step=1
-            )      
-
-    
-
-    center, bounds, dimensions = map_settings(square,df_display,set_mmsi)
+            step=1,
+            key="opacity_choice"
+            )
 
-    m2 = folium.Map(location=[center[0], center[1]],zoom_control=True, scrollWheelZoom=True,dragging=True, tiles='OpenStreetMap')
+    m2 = folium.Map(location=[center[0], center[1]],zoom_control=True, scrollWheelZoom=True,dragging=True, tiles='OpenStreetMap', prefer_canvas=True)
 
 
     if coords:
@@ -153,21 +143,48 @@ if rows:
     cmap_types = matplotlib.colormaps.get_cmap('tab20')
     colormap_type=colormaps(cmap=cmap_types,list_type=list_type_ihs)
 
-    cmap_choice = droite.radio(
+    # Nombre de messages par pixel, bornes fixées d'après l'image (add_density_layer)
+    colormap_count=colormaps(matplotlib.colors.LogNorm(),matplotlib.colormaps.get_cmap('jet'),'count')
+
+    density_dict = {
+    "Nombre de messages": ("count", colormap_count),
+    "Vitesse moyenne": ("sog", colormap_speed),
+    "Tirant d'eau max": ("Draft", colormap_draft)
+    }
+
+    if density_mode:
+        density_choice = droite_style.radio(
+            "Valeur des pixels :",
+            options=list(density_dict),
+            index=0,
+            horizontal=True,
+            key="density_choice"
+        )
+
+    if aggregate_mode:
+        cell_shape = droite_style.radio(
+            "Forme des cellules :",
+            options=["Hexagone", "Carré"],
+            index=0,
+            horizontal=True,
+            key="cell_shape"
+        )
+
+    cmap_choice = "Pas de coloration" if density_mode else droite_style.radio(
         "Couleur des points :",
         options=["Pas de coloration","Vitesse", "Tirant d'eau", "Type de navire"],
         index=0,
         horizontal=True,
         key="cmap_choice"
     )
-    size_choice = droite.radio(
+    size_choice = "Constante" if all_messages else droite_style.radio(
         "Taille des points :",
         options=["Constante", "Taille des navires"],
         index=0,
         horizontal=True,
         key="size_choice"
     )
-    shape_choice = droite.radio(
+    shape_choice = "Ronde" if all_messages else droite_style.radio(
         "Forme des navires :",
         options=["Ronde", "Réelle"],
         index=0,
@@ -183,26 +200,39 @@ if rows:
     }
 
 
-    st.sidebar.metric("MMSI distincts récupérés :", numerize(len(set_mmsi)))
-    st.sidebar.download_button(
-            label="Télécharger la liste des mmsi (CSV)",
-            data=pd.DataFrame(set_mmsi, columns=["mmsi"]).to_csv(index=False).encode('utf-8'),
-            file_name="mmsi_selection.csv",
-            mime="text/csv"
-        )
-    st.sidebar.metric("Messages AIS récupérés :", numerize(len(df_complete)))
-    if shape_choice == "Réelle":
-        st.sidebar.metric("Messages affichés après filtres :", numerize(len(df_display["Length"].dropna())))
-        st.sidebar.info("Certains navires ont des dimensions inconnues et ne sont donc pas affichés quand l'option de forme réelle est sélectionnée.")
-    else:
-        st.sidebar.metric("Messages affichés après filtres :", numerize(len(df_display)))
+    if not all_messages:
+        # Densité et trajectoires de toute la période en tuiles, sous les points (légende seulement sans coloration des points)
+        add_tile_layers(m2, date_range[0], date_range[1], opacity_choice, legend=color_map_dict[cmap_choice] is None)
+
+    # Un message échantillonné en représente 1 / sample_rate
+    weight = 1 / plan["sample_rate"] if plan["mode"] == "sample" else 1.0
+    switch = None
 
+    if density_mode:
 
+        stat, colormap_density = density_dict[density_choice]
+        add_density_layer(m2, df_display, bounds, colormap_density, stat, opacity_choice, weight)
 
-    if shape_choice=="Réelle":
+    elif aggregate_mode:
 
-        df_display['polygon']= create_poly_with_arrow(df_display)
-        add_points_poly(m2, df_display, color_map_dict[cmap_choice],opacity_choice)
+        shape = "hex" if cell_shape == "Hexagone" else "square"
+        cell_m = aggregation_cell_m(bounds)
+        cells = aggregate_cells(df_display, fingerprint, cell_m, shape, weight)
+        cells_layer = folium.FeatureGroup(name="Cellules", control=False).add_to(m2)
+        add_cells_layer(cells_layer, cells, cell_m, shape, color_map_dict[cmap_choice], opacity_choice)
+        # En zoomant, les cellules deviennent trop grandes : elles sont remplacées par un échantillon de max_points messages
+        points_layer = folium.FeatureGroup(name="Messages", control=False, show=False).add_to(m2)
+        df_points = df_display.sample(min(max_points, len(df_display)), random_state=42)
+        add_points_circle(points_layer, df_points, color_map_dict[cmap_choice], "Constante", opacity_choice, legend=False)
+        switch = zoom_switch(cells_layer, points_layer)
+        gauche_style.caption(f"{numerize(len(cells))} cellules affichées, remplacées par {numerize(len(df_points))} messages" \
+        f" au-delà de {aggregation_points_zoom} niveaux de zoom.")
+
+    elif shape_choice=="Réelle":
+
+        add_points_poly(m2, df_display.assign(polygon=create_poly_with_arrow(df_display)), color_map_dict[cmap_choice],opacity_choice)
+        gauche_style.caption(f"{numerize(len(df_display['Length'].dropna()))} messages affichés : certains navires ont des dimensions inconnues" \
+        " et ne sont donc pas affichés quand l'option de forme réelle est sélectionnée.")
 
     elif shape_choice=="Ronde":
 
@@ -211,8 +241,101 @@ if rows:
             
 
     m2.fit_bounds(bounds,padding=(0, 0))
+    if switch is not None:
+        switch.add_to(m2)
     m2.add_child(MeasureControl(primary_length_unit='meters'))
-    st_folium(m2,use_container_width=True)
+    # Aucun état de la carte n'est renvoyé : se déplacer ou zoomer ne relance pas le script
+    st_folium(m2,use_container_width=True,returned_objects=[])
+
+
+max_points = gauche.slider(
+    "Nombre de points affichés ",
+    min_value=10,
+    max_value=10000,
+    value=1000,
+    step=500
+)
+
+# Sans liste de MMSI, seul l'échantillon affiché est transféré depuis la base.
+# Les modes agrégation et densité récupèrent tous les messages, dans la limite de raster_row_budget
+sample_size = None if (all_messages or list_mmsi_user) else max_points
+
+def load_messages():
+    if all_messages:
+        plan = plan_points_query(date_range[0], date_range[1],min_lat, max_lat, min_long, max_long,list_mmsi_user, row_budget=raster_row_budget)
+    else:
+        plan = plan_points_query(date_range[0], date_range[1],min_lat, max_lat, min_long, max_long,list_mmsi_user, sample_size=sample_size)
+    rows = get_points(date_range[0], date_range[1],min_lat, max_lat, min_long, max_long,list_mmsi_user, loader="copy", plan=plan, sample_size=sample_size)
+    df_ihs, df_complete, set_mmsi = create_all_df(rows)
+    # Index par navire pour per_mmsi_filter, construit une fois par sélection
+    messages = ais_messages.from_dataframe(df_complete) if list_mmsi_user and not all_messages else None
+    # Si seul un échantillon a été récupéré, la liste des MMSI et les données des graphiques viennent de toute la sélection
+    complete = plan["mode"] == "full" and (sample_size is None or len(df_complete) < sample_size)
+    if complete:
+        df_counts = df_complete['mmsi'].value_counts().rename_axis('mmsi').reset_index(name='count')
+    else:
+        df_counts = get_points_counts(date_range[0], date_range[1],min_lat, max_lat, min_long, max_long,list_mmsi_user)
+    df_ihs_selection, df_vessels = create_vessels_df(df_counts)
+    return plan, df_ihs, df_complete, set_mmsi, messages, complete, df_ihs_selection, df_vessels
+
+# Requête, données IHS et fusion ne sont refaites que si la sélection change
+plan, df_ihs, df_complete, set_mmsi, messages, complete, df_ihs_selection, df_vessels = session_memo(
+    "messages",
+    (date_range, square, str(list_mmsi_user), all_messages, sample_size),
+    load_messages
+)
+
+if len(df_complete) > 0:
+    list_type_ihs = df_ihs['Ship type for pie chart'].fillna("Unknown").unique()
+
+    # Les graphiques portent sur tous les navires de la sélection, pas seulement sur l'échantillon affiché
+    st.session_state['df_ihs']=df_ihs_selection
+    st.session_state['df']=df_complete if complete else df_vessels
+
+    if len(df_complete) > max_points and not all_messages:
+        df_display = df_complete.sample(max_points, random_state=42)
+    else:
+        df_display = df_complete
+
+    
+    if list_mmsi_user and not all_messages:
+        df_display = per_mmsi_filter(df_complete,set_mmsi,df_display,messages)
+    with droite:
+        df_display=per_ship_type_filter(df_display,df_ihs)
+
+    center, bounds, dimensions = map_settings(square,df_display,set_mmsi)
+
+    # En dessous de aggregation_min_points messages (petite zone, courte période...), les messages sont affichés directement,
+    # dans la limite du nombre de points affichés
+    min_points = min(aggregation_min_points, max_points)
+    if aggregate_mode and len(df_display) <= min_points:
+        aggregate_mode = all_messages = False
+        gauche.info(f"Moins de {min_points} messages dans la sélection : affichage des messages.")
+
+
+    st.sidebar.metric("MMSI distincts dans la sélection :", numerize(len(df_vessels)))
+    st.sidebar.download_button(
+            label="Télécharger la liste des mmsi (CSV)",
+            data=df_vessels[["mmsi"]].astype(str).to_csv(index=False).encode('utf-8'),
+            file_name="mmsi_selection.csv",
+            mime="text/csv"
+        )
+    st.sidebar.metric("Messages AIS dans la sélection :", numerize(int(df_vessels["count"].sum())))
+    st.sidebar.metric("Messages AIS récupérés :", numerize(len(df_complete)))
+    plan_details = [plan['label']]
+    if plan["estimated_rows"] is not None:
+        plan_details.append(f"{numerize(plan['estimated_rows'])} lignes estimées")
+    if plan["sample_rate"] is not None:
+        plan_details.append(f"taux d'échantillonnage de {plan['sample_rate']:.2%}")
+    st.sidebar.caption("Plan de requête : " + ", ".join(plan_details) + ".")
+    st.sidebar.metric("Messages affichés après filtres :", numerize(len(df_display)))
+    if density_mode and plan["mode"] == "aggregate":
+        st.sidebar.info("La sélection dépasse le volume maximal : l'image compte le dernier message de chaque navire par cellule.")
+
+
+    # Clé de cache des cellules : contenu des messages affichés, quels que soient les filtres qui l'ont produit
+    fingerprint = frame_fingerprint(df_display) if aggregate_mode else None
+    render_map(df_display, bounds, center, plan, list_type_ihs, density_mode, aggregate_mode, fingerprint, max_points)
 
     
 
@@ -223,7 +346,7 @@ if rows:
     st.markdown("## Tableau des données affichées.")    
     st.text(" Il est possible de le télécharger.")
 
-    make_dataframe(df_display)
+    make_dataframe(df_display.head(max_points) if all_messages else df_display)
     
     if st.button("Visualiser les graphs",use_container_width=True,key="flux_graph_button",type= "primary"):
                 st.switch_page("pages/4_flux_graphs.py") 
@@ -92,19 +92,137 @@ date_range_traj = gauche.slider(
         )
     
 
-if (date_range_traj[0]!=date_range[0]) or (date_range_traj[1]!=(date_range[0]+ timedelta(days=1))):
+@st.fragment
+def render_map(df_display, bounds, center, list_type_ihs):
+    """
+    Options d'affichage et carte. Le fragment est seul relancé quand une option d'affichage change :
+    les données, les filtres et la simplification des trajectoires ne sont pas recalculés.
+    """
+    gauche_style, droite_style = st.columns(2)
+
+    opacity_choice=gauche_style.slider(
+        "Sélection de l'opacité des navires (%)",
+        min_value=0,
+        max_value=100,
+        value=80,
+        step=1,
+        key="opacity_choice"
+        )      
+
+    
+
+
+    m4 = folium.Map(location=[center[0], center[1]],zoom_control=True, scrollWheelZoom=True,dragging=True, tiles='OpenStreetMap', prefer_canvas=True)
+
+    if coords:
+
+        if not list_mmsi_user:
+            for poly in create_rectangles(bounds):
+                folium.Polygon(
+                    locations= poly, 
+                    color='white',
+                    weight=0,
+                    fill=True,
+                    fill_opacity=0.6,
+                ).add_to(m4)
+
+        folium.Polygon(
+            locations= [
+                bounds[0], 
+                (bounds[0][0],bounds[1][1]),
+                bounds[1],
+                (bounds[1][0],bounds[0][1])
+                        ],
+            color='gray',
+            weight=2,
+            fill=False
+        ).add_to(m4)
+
+    
+    norm_sog = matplotlib.colors.PowerNorm(gamma=0.8,vmin=0, vmax=25)
+    cmap_sog = matplotlib.colormaps.get_cmap('jet')
+    colormap_speed=colormaps(norm_sog,cmap_sog,'sog')
+
+    norm_draft = matplotlib.colors.PowerNorm(gamma=0.6,vmin=0, vmax=26)
+    cmap_draft = matplotlib.colormaps.get_cmap('jet')
+    colormap_draft=colormaps(norm_draft,cmap_draft,'Draft')
+
+    cmap_types = matplotlib.colormaps.get_cmap('tab20')
+    colormap_type=colormaps(cmap=cmap_types,list_type=list_type_ihs)
+
+    cmap_choice = droite_style.radio(
+        "Couleur des points :",
+        options=["Pas de coloration","Vitesse", "Tirant d'eau", "Type de navire"],
+        index=0,
+        horizontal=True,
+        key="cmap_choice"
+    )
+    size_choice = droite_style.radio(
+        "Taille des points :",
+        options=["Constante", "Taille des navires"],
+        index=0,
+        horizontal=True,
+        key="size_choice"
+    )
+    shape_choice = droite_style.radio(
+        "Forme des navires :",
+        options=["Ronde", "Réelle"],
+        index=0,
+        horizontal=True,
+        key="shape_choice"
+    )
+    
+    color_map_dict = {
+    "Pas de coloration": None,
+    "Vitesse": colormap_speed,
+    "Tirant d'eau": colormap_draft,
+    "Type de navire": colormap_type
+    }
+
+    if shape_choice=="Réelle":
 
+        add_points_poly(m4, df_display.assign(polygon=create_poly_with_arrow(df_display)), color_map_dict[cmap_choice],opacity_choice,page_type='traj')
+        gauche_style.caption(f"{numerize(len(df_display['Length'].dropna()))} messages affichés : certains navires ont des dimensions inconnues" \
+        " et ne sont donc pas affichés quand l'option de forme réelle est sélectionnée.")
 
-    rows = get_points_with_traj(date_range[0], date_range[1],date_range_traj[0], date_range_traj[1],min_lat, max_lat, min_long, max_long, list_mmsi_user)
+    elif shape_choice=="Ronde":
 
+        add_points_circle(m4, df_display, color_map_dict[cmap_choice], size_choice,opacity_choice,page_type='traj')
 
-    if rows:
+            
+
+    m4.fit_bounds(bounds,padding=(0, 0))
+    m4.add_child(MeasureControl(primary_length_unit='meters'))
+    # Aucun état de la carte n'est renvoyé : se déplacer ou zoomer ne relance pas le script
+    st_folium(m4,use_container_width=True,returned_objects=[])
+
+
+if (date_range_traj[0]!=date_range[0]) or (date_range_traj[1]!=(date_range[0]+ timedelta(days=1))):
 
+
+    def load_trajectories():
+        rows, df_dest = get_traj_bundle(date_range[0], date_range[1],date_range_traj[0], date_range_traj[1],min_lat, max_lat, min_long, max_long, list_mmsi_user)
+        if len(rows) == 0:
+            return None, df_dest
         df_ihs, df_complete, set_mmsi = create_all_df(rows)
+        # Index par navire pour per_mmsi_filter, construit une fois par sélection
+        messages = ais_messages.from_dataframe(df_complete) if list_mmsi_user else None
+        return (df_ihs, df_complete, set_mmsi, messages), df_dest
+
+    # Requêtes, données IHS et fusion ne sont refaites que si la sélection change
+    all_df, df_dest = session_memo(
+        "trajectories",
+        (date_range, date_range_traj, square, str(list_mmsi_user)),
+        load_trajectories
+    )
+
+
+    if all_df is not None:
+
+        df_ihs, df_complete, set_mmsi, messages = all_df
         list_mmsi=list(set_mmsi)
 
         list_type_ihs = df_ihs['Ship type for pie chart'].fillna("Unknown").unique()
-        df_dest = get_dest_mmsi(date_range[0], date_range[1], list_mmsi)
        
         
         st.session_state['df_ihs']=df_ihs
@@ -121,99 +239,18 @@ if (date_range_traj[0]!=date_range[0]) or (date_range_traj[1]!=(date_range[0]+ t
 
 
         if list_mmsi_user:
-            df_display = per_mmsi_filter(df_complete,list_mmsi,df_complete)
+            df_display = per_mmsi_filter(df_complete,list_mmsi,df_complete,messages)
         with droite:
             df_display=per_ship_type_filter(df_complete,df_ihs)
 
-        if len(df_display) > max_points:
-            df_display = df_display.sort_values("timestamp").sample(frac=max_points/len(df_display) , random_state=5).iloc[:max_points] 
-            max_timestamp = df_display['timestamp'].max()
-            st.error(f"Attention : les points sont affichés jusqu'au {max_timestamp}. Pour afficher plus de points, augmentez le nombre maximum de points affichés.")
-
-        else:
-            df_display = df_display.sort_values("timestamp")
-
-
-
-        opacity_choice=gauche.slider(
-            "Sélection de l'opacité des navires (%)",
-            min_value=0,
-            max_value=100,
-            value=80,
-            step=1
-            )      
-
-        
-
-
         center, bounds, dimensions = map_settings(square,df_display,list_mmsi)
 
-        m4 = folium.Map(location=[center[0], center[1]],zoom_control=True, scrollWheelZoom=True,dragging=True, tiles='OpenStreetMap')
-
-        if coords:
-
-            if not list_mmsi_user:
-                for poly in create_rectangles(bounds):
-                    folium.Polygon(
-                        locations= poly, 
-                        color='white',
-                        weight=0,
-                        fill=True,
-                        fill_opacity=0.6,
-                    ).add_to(m4)
-
-            folium.Polygon(
-                locations= [
-                    bounds[0], 
-                    (bounds[0][0],bounds[1][1]),
-                    bounds[1],
-                    (bounds[1][0],bounds[0][1])
-                            ],
-                color='gray',
-                weight=2,
-                fill=False
-            ).add_to(m4)
+        if len(df_display) > max_points:
+            df_display = simplify_tracks(df_display, max_points, tolerance_m=map_tolerance_m(bounds))
+            st.info(f"Trajectoires simplifiées : {len(df_display)} points affichés, virages et arrêts conservés." \
+            " Pour afficher plus de points, augmentez le nombre maximum de points affichés.")
 
-        
-        norm_sog = matplotlib.colors.PowerNorm(gamma=0.8,vmin=0, vmax=25)
-        cmap_sog = matplotlib.colormaps.get_cmap('jet')
-        colormap_speed=colormaps(norm_sog,cmap_sog,'sog')
-
-        norm_draft = matplotlib.colors.PowerNorm(gamma=0.6,vmin=0, vmax=26)
-        cmap_draft = matplotlib.colormaps.get_cmap('jet')
-        colormap_draft=colormaps(norm_draft,cmap_draft,'Draft')
-
-        cmap_types = matplotlib.colormaps.get_cmap('tab20')
-        colormap_type=colormaps(cmap=cmap_types,list_type=list_type_ihs)
-
-        cmap_choice = droite.radio(
-            "Couleur des points :",
-            options=["Pas de coloration","Vitesse", "Tirant d'eau", "Type de navire"],
-            index=0,
-            horizontal=True,
-            key="cmap_choice"
-        )
-        size_choice = droite.radio(
-            "Taille des points :",
-            options=["Constante", "Taille des navires"],
-            index=0,
-            horizontal=True,
-            key="size_choice"
-        )
-        shape_choice = droite.radio(
-            "Forme des navires :",
-            options=["Ronde", "Réelle"],
-            index=0,
-            horizontal=True,
-            key="shape_choice"
-        )
-        
-        color_map_dict = {
-        "Pas de coloration": None,
-        "Vitesse": colormap_speed,
-        "Tirant d'eau": colormap_draft,
-        "Type de navire": colormap_type
-        }
+        df_display = df_display.sort_values("timestamp")
 
 
         st.sidebar.metric("MMSI distincts récupérés :", numerize(len(set_mmsi)))
@@ -224,26 +261,9 @@ if (date_range_traj[0]!=date_range[0]) or (date_range_traj[1]!=(date_range[0]+ t
                 mime="text/csv"
             )
         st.sidebar.metric("Messages AIS récupérés :", numerize(len(df_complete)))
-        if shape_choice == "Réelle":
-            st.sidebar.metric("Messages affichés après filtres :", numerize(len(df_display["Length"].dropna())))
-            st.sidebar.info("Certains navires ont des dimensions inconnues et ne sont donc pas affichés quand l'option de forme réelle est sélectionnée.")
-        else:
-            st.sidebar.metric("Messages affichés après filtres :", numerize(len(df_display)))
-
-        if shape_choice=="Réelle":
-
-            df_display['polygon']= create_poly_with_arrow(df_display)
-            add_points_poly(m4, df_display, color_map_dict[cmap_choice],opacity_choice,page_type='traj')
-
-        elif shape_choice=="Ronde":
-
-            add_points_circle(m4, df_display, color_map_dict[cmap_choice], size_choice,opacity_choice,page_type='traj')
-
-                
+        st.sidebar.metric("Messages affichés après filtres :", numerize(len(df_display)))
 
-        m4.fit_bounds(bounds,padding=(0, 0))
-        m4.add_child(MeasureControl(primary_length_unit='meters'))
-        st_folium(m4,use_container_width=True)
+        render_map(df_display, bounds, center, list_type_ihs)
 
 
         st.info("Si vous voulez garder la carte, vous pouvez télécharger la page en HTML." \
@@ -70,45 +70,40 @@ date_range = gauche.slider(
 gauche.info("La période de récupération des messages est de 1 jour avant la date limite.")
 
 
-rows = get_points((date_range- datetime.timedelta(days=150)), date_range,min_lat, max_lat, min_long, max_long, )
-
-if rows:
-    df_ihs,df,set_mmsi = create_all_df_screen(rows)
-    list_type_ihs = df_ihs['Ship type for pie chart'].fillna("Unknown").unique()
-
-
-    st.session_state['df_ihs']=df_ihs
-    st.session_state['df']=df
-    
+max_points = gauche.slider(
+    "Nombre de points affichés sur la carte",
+    min_value=1000,
+    max_value=10000,
+    value=1000,
+    step=500
+)
 
-    max_points = gauche.slider(
-        "Nombre de points affichés sur la carte",
-        min_value=1000,
-        max_value=10000,
-        value=min(1000, len(df)),
-        step=500
-    )
+# Requête, données IHS et fusion ne sont refaites que si la sélection change.
+# La photo complète (une ligne par navire) est gardée : seule la couche affichée est échantillonnée
+df_ihs,df,set_mmsi = session_memo(
+    "last_messages",
+    (date_range, square),
+    lambda: create_all_df_screen(get_last_points(date_range, min_lat, max_lat, min_long, max_long))
+)
 
-    if len(df) > max_points:
-        df_display = df.sample(max_points, random_state=42)
-    else:
-        df_display = df
-    with droite:
-        df_display=per_ship_type_filter(df_display,df_ihs)
+@st.fragment
+def render_map(df_display, bounds, center, list_type_ihs):
+    """
+    Options d'affichage et carte. Le fragment est seul relancé quand une option d'affichage change :
+    les données et les filtres ne sont pas recalculés.
+    """
+    gauche_style, droite_style = st.columns(2)
 
-    opacity_choice=gauche.slider(
+    opacity_choice=gauche_style.slider(
         "Sélection de l'opacité des navires (%)",
         min_value=0,
         max_value=100,
         value=80,
-        step=1
+        step=1,
+        key="opacity_choice"
         ) 
 
-
-
-    center, bounds, dimensions = map_settings(square,df_display)
-    
-    m2 = folium.Map(location=[center[0], center[1]],zoom_control=True, scrollWheelZoom=True,dragging=True, tiles='OpenStreetMap')
+    m2 = folium.Map(location=[center[0], center[1]],zoom_control=True, scrollWheelZoom=True,dragging=True, tiles='OpenStreetMap', prefer_canvas=True)
 
 
     if coords:
@@ -135,7 +130,7 @@ if rows:
 
     norm_sog = matplotlib.colors.Normalize(vmin=0, vmax=25)
     cmap_sog = matplotlib.colormaps.get_cmap('jet')
-    colormap_speed=colormaps(norm_sog,cmap_sog)
+    colormap_speed=colormaps(norm_sog,cmap_sog,'sog')
 
     norm_draft = matplotlib.colors.PowerNorm(gamma=0.6,vmin=0, vmax=26)
     cmap_draft = matplotlib.colormaps.get_cmap('jet')
@@ -144,21 +139,21 @@ if rows:
     cmap_types = matplotlib.colormaps.get_cmap('tab20')
     colormap_type=colormaps(cmap=cmap_types,list_type=list_type_ihs)
 
-    cmap_choice = droite.radio(
+    cmap_choice = droite_style.radio(
         "Couleur des points :",
         options=["Pas de coloration","Vitesse", "Tirant d'eau", "Type de navire"],
         index=0,
         horizontal=True,
         key="cmap_choice"
     )
-    size_choice = droite.radio(
+    size_choice = droite_style.radio(
         "Taille des points :",
         options=["Constante", "Taille des navires"],
         index=0,
         horizontal=True,
         key="size_choice"
     )
-    shape_choice = droite.radio(
+    shape_choice = droite_style.radio(
         "Forme des navires :",
         options=["Ronde", "Réelle"],
         index=0,
@@ -173,25 +168,12 @@ if rows:
     "Type de navire": colormap_type
     }
 
-    st.sidebar.metric("MMSI distincts récupérés :", numerize(len(set_mmsi)))
-    st.sidebar.download_button(
-            label="Télécharger la liste des mmsi (CSV)",
-            data=pd.DataFrame(set_mmsi, columns=["mmsi"]).to_csv(index=False).encode('utf-8'),
-            file_name="mmsi_selection.csv",
-            mime="text/csv"
-        )
-    st.sidebar.metric("Messages AIS récupérés :", numerize(len(df)))
-    if shape_choice == "Réelle":
-        st.sidebar.metric("Messages affichés après filtres :", numerize(len(df_display["Length"].dropna())))
-        st.sidebar.info("Certains navires ont des dimensions inconnues et ne sont donc pas affichés quand l'option de forme réelle est sélectionnée.")
-    else:
-        st.sidebar.metric("Messages affichés après filtres :", numerize(len(df_display)))
-
 
     if shape_choice=="Réelle":
 
-        df_display['polygon']= create_poly_with_arrow(df_display)
-        add_points_poly(m2, df_display, color_map_dict[cmap_choice],opacity_choice)
+        add_points_poly(m2, df_display.assign(polygon=create_poly_with_arrow(df_display)), color_map_dict[cmap_choice],opacity_choice)
+        gauche_style.caption(f"{numerize(len(df_display['Length'].dropna()))} messages affichés : certains navires ont des dimensions inconnues" \
+        " et ne sont donc pas affichés quand l'option de forme réelle est sélectionnée.")
 
     elif shape_choice=="Ronde":
 
@@ -201,7 +183,37 @@ if rows:
 
     m2.fit_bounds(bounds,padding=(0, 0))
     m2.add_child(MeasureControl(primary_length_unit='meters'))
-    st_folium(m2,use_container_width=True)
+    # Aucun état de la carte n'est renvoyé : se déplacer ou zoomer ne relance pas le script
+    st_folium(m2,use_container_width=True,returned_objects=[])
+
+
+if len(df) > 0:
+    list_type_ihs = df_ihs['Ship type for pie chart'].fillna("Unknown").unique()
+
+
+    st.session_state['df_ihs']=df_ihs
+    st.session_state['df']=df
+
+    if len(df) > max_points:
+        df_display = df.sample(max_points, random_state=42)
+    else:
+        df_display = df
+    with droite:
+        df_display=per_ship_type_filter(df_display,df_ihs)
+
+    center, bounds, dimensions = map_settings(square,df_display)
+
+    st.sidebar.metric("MMSI distincts récupérés :", numerize(len(set_mmsi)))
+    st.sidebar.download_button(
+            label="Télécharger la liste des mmsi (CSV)",
+            data=pd.DataFrame(set_mmsi, columns=["mmsi"]).to_csv(index=False).encode('utf-8'),
+            file_name="mmsi_selection.csv",
+            mime="text/csv"
+        )
+    st.sidebar.metric("Messages AIS récupérés :", numerize(len(df)))
+    st.sidebar.metric("Messages affichés après filtres :", numerize(len(df_display)))
+
+    render_map(df_display, bounds, center, list_type_ihs)
 
 
      
@@ -0,0 +1,344 @@
+"""
+Serveur de tuiles XYZ local pour les couches de densité des messages et de trajectoires.
+
+Processus indépendant, à lancer à côté de l'application Streamlit. Les cartes chargent les tuiles directement
+(add_tile_layers, activé par tile_server_url dans func.py) : se déplacer ou zoomer ne relance pas le script Streamlit.
+Chaque tuile est calculée à la demande par la base, puis gardée dans un cache disque
+tile_cache_dir/<table>/<couche>/<début>_<fin>/<z>/<x>/<y>.png. La commande seed pré-calcule les tuiles d'une zone.
+
+Couches :
+    density : nombre de messages par km² (agrégé par pixel dans la base), couleurs de tile_density_colormap.
+    tracks : trajectoires colorées par vitesse, à partir du zoom tile_tracks_min_zoom
+             (dernier message de chaque navire par pixel, voir points_sql).
+
+URL des tuiles : http://<hôte>:<port>/<couche>/<YYYY-MM-DD>/<YYYY-MM-DD>/<z>/<x>/<y>.png
+
+La connexion à la base utilise une section de .streamlit/secrets.toml ("local" par défaut).
+
+Usage :
+    python tile_server.py serve --port 8600
+    python tile_server.py seed --start 2025-01-01 --end 2025-12-31 --bbox 43 44 4 6 --zooms 5 10
+"""
+import argparse
+import datetime
+import io
+import math
+import os
+import re
+import threading
+import tomllib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional, Tuple
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.figure
+import numpy as np
+import psycopg2
+import psycopg2.pool
+from branca.utilities import write_png
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+
+from func import (bdd, colormaps, copy_points_sql, decode_copy_points, density_image, fetch_workers, points_query,
+                  points_sql, statement_timeout_ms, tile_cache_dir, tile_density_colormap, tile_tracks_min_zoom,
+                  traj_max_gap_s)
+
+
+tile_size = 256
+tile_layers = ("density", "tracks")
+# Marge (fraction de la tuile) autour d'une tuile de trajectoires, pour tracer les segments qui la traversent
+tracks_margin = 0.1
+# Épaisseur (pixels) des trajectoires
+tracks_width_px = 1.5
+# Nombre maximum de connexions ouvertes simultanément vers la base : une vue de carte demande une vingtaine de tuiles
+# à la fois, les requêtes au-delà attendent qu'une connexion se libère
+max_connections = fetch_workers
+
+_tile_path = re.compile(r"^/(density|tracks)/(\d{4}-\d{2}-\d{2})/(\d{4}-\d{2}-\d{2})/(\d{1,2})/(\d+)/(\d+)\.png$")
+_earth_circumference_m = 2 * math.pi * 6378137.0
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """
+    Limites (min_lat, max_lat, min_long, max_long) de la tuile (z, x, y) du découpage Web Mercator.
+    """
+    n = 2 ** z
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+    return lat(y + 1), lat(y), x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0
+
+
+def tiles_covering(min_lat: float, max_lat: float, min_long: float, max_long: float, z: int) -> Iterator[Tuple[int, int]]:
+    """
+    Tuiles (x, y) du zoom z qui recouvrent une zone.
+    """
+    n = 2 ** z
+    def col(long):
+        return min(n - 1, max(0, int((long + 180.0) / 360.0 * n)))
+    def row(lat):
+        lat = math.radians(max(-85.0511, min(85.0511, lat)))
+        return min(n - 1, max(0, int((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n)))
+    for x in range(col(min_long), col(max_long) + 1):
+        for y in range(row(max_lat), row(min_lat) + 1):
+            yield x, y
+
+
+def _pixel_sql(z: int, x: int, y: int) -> Tuple[str, str]:
+    """
+    Expressions SQL des coordonnées pixel (colonne, ligne) d'un message dans la tuile (z, x, y).
+    """
+    world_px = tile_size * 2 ** z
+    col = f"floor((long + 180.0) / 360.0 * {world_px})::int - {x * tile_size}"
+    row = (f"floor((1 - ln(tan(pi() / 4 + radians(least(greatest(lat, -85.0511), 85.0511)) / 2)) / pi()) / 2 * {world_px})::int"
+           f" - {y * tile_size}")
+    return col, row
+
+
+class tile_renderer():
+    """
+    Calcule les tuiles PNG à partir de la base. ThreadingHTTPServer lance un thread par requête :
+    les connexions sont donc prêtées par un pool borné à max_connections, partagé par tous les threads.
+
+    Attributes:
+        secret (dict): Paramètres de connexion psycopg2 (section de .streamlit/secrets.toml).
+        cache_dir (str): Dossier du cache disque des tuiles.
+        max_connections (int): Nombre maximum de connexions ouvertes simultanément.
+
+    Methods:
+        tile(layer, start, end, z, x, y) -> bytes:
+            Tuile PNG, lue dans le cache disque ou calculée puis écrite dans le cache.
+    """
+    def __init__(self, secret: dict, cache_dir: str = tile_cache_dir, max_connections: int = max_connections):
+        self.secret = secret
+        self.cache_dir = cache_dir
+        self.max_connections = max_connections
+        options = f"{secret.get('options', '')} -c statement_timeout={statement_timeout_ms}".strip()
+        self._pool = psycopg2.pool.ThreadedConnectionPool(0, max_connections, **{**secret, "options": options})
+        # ThreadedConnectionPool lève une erreur quand il est vide : le sémaphore fait attendre les requêtes en trop
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._empty = write_png(np.zeros((tile_size, tile_size, 4), dtype=np.uint8))
+        self._density_colormap = tile_density_colormap()
+        self._speed_colormap = colormaps(matplotlib.colors.PowerNorm(gamma=0.8, vmin=0, vmax=25), matplotlib.colormaps.get_cmap('jet'), 'sog')
+
+    @contextmanager
+    def _connection(self) -> Iterator[psycopg2.extensions.connection]:
+        with self._slots:
+            conn = self._pool.getconn()
+            conn.autocommit = True
+            broken = False
+            try:
+                yield conn
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                broken = True
+                raise
+            finally:
+                self._pool.putconn(conn, close=broken or bool(conn.closed))
+
+    def cache_path(self, layer: str, start: datetime.date, end: datetime.date, z: int, x: int, y: int) -> str:
+        return os.path.join(self.cache_dir, bdd, layer, f"{start}_{end}", str(z), str(x), f"{y}.png")
+
+    def tile(self, layer: str, start: datetime.date, end: datetime.date, z: int, x: int, y: int) -> bytes:
+        """
+        Renvoie la tuile PNG (z, x, y) d'une couche pour la période [start ; end], en passant par le cache disque.
+        """
+        path = self.cache_path(layer, start, end, z, x, y)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read()
+
+        if layer == "density":
+            png = self._density_tile(start, end, z, x, y)
+        else:
+            png = self._tracks_tile(start, end, z, x, y)
+
+        # Écriture atomique : un autre thread ne lit jamais une tuile à moitié écrite
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(png)
+        os.replace(tmp, path)
+        return png
+
+    def _query(self, start: datetime.date, end: datetime.date, bounds: Tuple[float, float, float, float]) -> dict:
+        return points_query(datetime.datetime.combine(start, datetime.time.min),
+                            datetime.datetime.combine(end, datetime.time.max), *bounds)
+
+    def _density_tile(self, start: datetime.date, end: datetime.date, z: int, x: int, y: int) -> bytes:
+        # Le comptage par pixel est fait par la base : au plus 256 x 256 lignes sont transférées
+        col, row = _pixel_sql(z, x, y)
+        sql = f"""
+            SELECT px, py, count(*)
+            FROM (SELECT {col} AS px, {row} AS py
+                  FROM ({points_sql(self._query(start, end, tile_bounds(z, x, y)))}) AS points) AS pixels
+            GROUP BY px, py
+            """
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql)
+            rows = np.array(cur.fetchall(), dtype=np.float64).reshape(-1, 3)
+            cur.close()
+        if len(rows) == 0:
+            return self._empty
+
+        px = np.clip(rows[:, 0].astype(np.int64), 0, tile_size - 1)
+        py = np.clip(rows[:, 1].astype(np.int64), 0, tile_size - 1)
+        counts = np.bincount(py * tile_size + px, weights=rows[:, 2], minlength=tile_size ** 2).reshape(tile_size, tile_size)
+
+        # Surface (km²) d'un pixel selon la latitude de sa ligne
+        n = 2 ** z
+        lat = np.arctan(np.sinh(np.pi * (1 - 2 * (y + (np.arange(tile_size) + 0.5) / tile_size) / n)))
+        pixel_km2 = (_earth_circumference_m * np.cos(lat) / (n * tile_size) / 1000) ** 2
+        grid = counts / pixel_km2[:, None]
+        grid[counts == 0] = np.nan
+        return write_png(density_image(grid, self._density_colormap, 100))
+
+    def _tracks_tile(self, start: datetime.date, end: datetime.date, z: int, x: int, y: int) -> bytes:
+        if z < tile_tracks_min_zoom:
+            return self._empty
+
+        min_lat, max_lat, min_long, max_long = tile_bounds(z, x, y)
+        margin_lat, margin_long = (max_lat - min_lat) * tracks_margin, (max_long - min_long) * tracks_margin
+        bounds = (min_lat - margin_lat, max_lat + margin_lat, min_long - margin_long, max_long + margin_long)
+        # Un seul message par navire et par pixel suffit au tracé
+        cell_deg = round((max_long - min_long) / tile_size, 8)
+        buffer = io.BytesIO()
+        with self._connection() as conn:
+            cur = conn.cursor()
+            cur.copy_expert(copy_points_sql(points_sql(self._query(start, end, bounds), cell_deg=cell_deg)), buffer)
+            cur.close()
+        columns = decode_copy_points(buffer.getbuffer())
+        if len(columns["mmsi"]) < 2:
+            return self._empty
+
+        order = np.lexsort((columns["timestamp"], columns["mmsi"]))
+        mmsi, timestamp, sog = columns["mmsi"][order], columns["timestamp"][order], columns["sog"][order]
+        world_px = tile_size * 2 ** z
+        px = (columns["long"][order] + 180.0) / 360.0 * world_px - x * tile_size
+        lat = np.radians(np.clip(columns["lat"][order], -85.0511, 85.0511))
+        py = (1 - np.arcsinh(np.tan(lat)) / np.pi) / 2 * world_px - y * tile_size
+
+        # Segments entre messages consécutifs d'un même navire, coupés au-delà de traj_max_gap_s
+        keep = mmsi[1:] == mmsi[:-1]
+        if traj_max_gap_s is not None:
+            keep &= np.diff(timestamp) <= traj_max_gap_s * 1_000_000_000
+        if not keep.any():
+            return self._empty
+        segments = np.stack([np.column_stack([px[:-1], py[:-1]]), np.column_stack([px[1:], py[1:]])], axis=1)[keep]
+        colors = self._speed_colormap.lut_rgba[self._speed_colormap.values_to_indices(sog[:-1][keep])] / 255.0
+
+        fig = matplotlib.figure.Figure(figsize=(1, 1), dpi=tile_size)
+        fig.patch.set_alpha(0)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        ax.set_xlim(0, tile_size)
+        ax.set_ylim(tile_size, 0)
+        # Épaisseur en points (1/72 de pouce) pour tracks_width_px pixels, la figure faisant 1 pouce de tile_size pixels
+        ax.add_collection(LineCollection(segments, colors=colors, linewidths=tracks_width_px * 72 / tile_size))
+        canvas.draw()
+        return write_png(np.asarray(canvas.buffer_rgba()))
+
+
+def parse_tile_path(path: str) -> Optional[tuple]:
+    """
+    Découpe une URL de tuile en (couche, début, fin, z, x, y), ou None si elle est invalide.
+    """
+    match = _tile_path.match(path.split("?", 1)[0])
+    if match is None:
+        return None
+    layer, start, end, z, x, y = match.groups()
+    try:
+        start, end = datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)
+    except ValueError:
+        return None
+    z, x, y = int(z), int(x), int(y)
+    if start > end or z > 22 or x >= 2 ** z or y >= 2 ** z:
+        return None
+    return layer, start, end, z, x, y
+
+
+def make_handler(renderer: tile_renderer) -> type:
+    class tile_handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            tile = parse_tile_path(self.path)
+            if tile is None:
+                self.send_error(404, "Tuile inconnue")
+                return
+            try:
+                png = renderer.tile(*tile)
+            except Exception as e:
+                self.send_error(500, f"Erreur de calcul de la tuile : {e}")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(png)))
+            self.send_header("Cache-Control", "max-age=86400")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(png)
+
+        def log_message(self, format, *args):
+            pass
+
+    return tile_handler
+
+
+def load_secret(secrets_path: str, secret_name: str) -> dict:
+    """
+    Lit une section de .streamlit/secrets.toml (mêmes paramètres de connexion que l'application).
+    """
+    with open(secrets_path, "rb") as f:
+        return tomllib.load(f)[secret_name]
+
+
+def seed(renderer: tile_renderer, layer: str, start: datetime.date, end: datetime.date,
+         bbox: Tuple[float, float, float, float], zooms: range, workers: int) -> None:
+    """
+    Pré-calcule les tuiles d'une zone pour une plage de zooms (les tuiles déjà en cache sont ignorées).
+    """
+    tiles = [(z, x, y) for z in zooms for x, y in tiles_covering(*bbox, z)]
+    print(f"{len(tiles)} tuiles à calculer ({layer}, {start} - {end})")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i, _ in enumerate(pool.map(lambda t: renderer.tile(layer, start, end, *t), tiles), 1):
+            if i % 100 == 0 or i == len(tiles):
+                print(f"  {i}/{len(tiles)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serveur de tuiles XYZ des messages AIS (densité et trajectoires).")
+    parser.add_argument("--secrets", default=os.path.join(".streamlit", "secrets.toml"), help="Fichier de secrets Streamlit.")
+    parser.add_argument("--secret-name", default="local", help="Section de connexion à la base dans le fichier de secrets.")
+    parser.add_argument("--cache-dir", default=tile_cache_dir, help="Dossier du cache disque des tuiles.")
+    parser.add_argument("--max-connections", type=int, default=max_connections,
+                        help="Nombre maximum de connexions simultanées à la base.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="Sert les tuiles en HTTP.")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8600)
+
+    seed_parser = commands.add_parser("seed", help="Pré-calcule les tuiles d'une zone.")
+    seed_parser.add_argument("--layer", choices=tile_layers, default="density")
+    seed_parser.add_argument("--start", type=datetime.date.fromisoformat, required=True)
+    seed_parser.add_argument("--end", type=datetime.date.fromisoformat, required=True)
+    seed_parser.add_argument("--bbox", type=float, nargs=4, required=True, metavar=("MIN_LAT", "MAX_LAT", "MIN_LONG", "MAX_LONG"))
+    seed_parser.add_argument("--zooms", type=int, nargs=2, default=[5, 10], metavar=("Z_MIN", "Z_MAX"))
+    seed_parser.add_argument("--workers", type=int, default=fetch_workers)
+
+    args = parser.parse_args()
+    renderer = tile_renderer(load_secret(args.secrets, args.secret_name), args.cache_dir, args.max_connections)
+
+    if args.command == "serve":
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(renderer))
+        print(f"Tuiles servies sur http://{args.host}:{args.port}/<couche>/<début>/<fin>/<z>/<x>/<y>.png")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    else:
+        seed(renderer, args.layer, args.start, args.end, tuple(args.bbox), range(args.zooms[0], args.zooms[1] + 1), args.workers)